@@ -0,0 +1,210 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmarks of the hot paths of zope.untrustedpython.
+
+The suite uses pyperf, which writes the results as JSON, so runs of two
+releases can be compared::
+
+    pip install pyperf
+    python benchmarks/bench_suite.py -o new.json
+    python -m pyperf compare_to old.json new.json
+
+The ``exec-getattr*`` benchmarks record the number of security proxies
+an execution creates as the ``proxies_created`` metadata, shown by
+``python -m pyperf show --metadata``.  The ``import-*`` benchmarks
+measure the time to start an interpreter and import a module,
+``import-none`` being the baseline.  Use ``--fast`` for a quick run and
+``--select`` to run only the benchmarks whose names start with one of
+the given prefixes.
+"""
+import builtins
+import io
+import sys
+
+import pyperf
+from zope.security.checker import NamesChecker
+from zope.security.checker import ProxyFactory
+from zope.security.checker import defineChecker
+
+from zope.untrustedpython import rcompile
+from zope.untrustedpython.builtins import FastSafeBuiltins
+from zope.untrustedpython.builtins import SafeBuiltins
+from zope.untrustedpython.builtins import value_safe_names
+from zope.untrustedpython.guards import ProxyCache
+from zope.untrustedpython.guards import guarded_getattr
+from zope.untrustedpython.interpreter import CompiledExpression
+from zope.untrustedpython.interpreter import CompiledProgram
+from zope.untrustedpython.interpreter import ExecutionContext
+from zope.untrustedpython.sandbox import Sandbox
+from zope.untrustedpython.scheduler import Scheduler
+
+
+def time_calls(loops, func, *args):
+    range_it = range(loops)
+    t0 = pyperf.perf_counter()
+    for _ in range_it:
+        func(*args)
+    return pyperf.perf_counter() - t0
+
+
+def source_of_size(lines):
+    return ''.join(f'x{i} = y * {i} + abs(z)\n' for i in range(lines))
+
+
+def compile_benchmarks():
+    uncached = rcompile.CompileCache(maxsize=0)
+    cached = rcompile.CompileCache()
+    for lines in (1, 10, 100):
+        yield (f'compile-{lines}-lines', uncached.compile,
+               source_of_size(lines), '<bench>', 'exec')
+    yield ('compile-cached', cached.compile,
+           source_of_size(10), '<bench>', 'exec')
+
+
+def eval_benchmarks():
+    expr = CompiledExpression('x * 2 + y')
+    attr = CompiledExpression('x.real * 2')
+    calls = CompiledExpression('len(x) + abs(y) + max(y, 0)')
+    context = ExecutionContext()
+    fast_context = ExecutionContext(builtins=FastSafeBuiltins)
+    values = {'x': 1, 'y': 2}
+    yield 'eval', expr.eval, values
+    yield 'eval-getattr', attr.eval, {'x': 2 + 1j}
+    yield 'eval-copied-globals', lambda: expr.eval(dict(values))
+    yield 'eval-context', context.eval, expr, values
+    yield 'eval-context-calls', context.eval, calls, {'x': 'ab', 'y': -1}
+    yield ('eval-context-calls-fast', fast_context.eval, calls,
+           {'x': 'ab', 'y': -1})
+
+
+def exec_benchmarks():
+    program = CompiledProgram('print("line", x)\n' * 20 + 'res = printed\n')
+
+    def exec_print(**kw):
+        program.exec_({'x': 1}, output=io.StringIO(), **kw)
+
+    yield 'exec-print', exec_print
+    yield 'exec-print-streaming', lambda: exec_print(buffer_size=1024)
+
+    prelude = ''.join(f'def helper{i}(x):\n    return x * {i}\n'
+                      for i in range(20))
+    compiled_prelude = CompiledProgram(prelude)
+    request = CompiledProgram('result = helper3(x) + helper7(x)')
+    sandbox = Sandbox(prelude)
+
+    def exec_prelude():
+        globals = {'x': 1}
+        compiled_prelude.exec_(globals)
+        request.exec_(globals)
+
+    yield 'exec-prelude', exec_prelude
+    yield 'exec-sandbox', sandbox.exec_, request, {'x': 1}
+
+    cheap = CompiledProgram('y = x * 2')
+    scheduler = Scheduler(max_processes=0)
+    yield 'exec-scheduled-inline', lambda: scheduler.submit(
+        cheap, {'x': 1}).result()
+
+
+class Settings:
+    rate = 2
+
+
+class Config:
+    def __init__(self):
+        self.settings = Settings()
+
+
+defineChecker(Config, NamesChecker(['settings']))
+defineChecker(Settings, NamesChecker(['rate']))
+
+
+def proxy_benchmarks():
+    # Yield the proxies created by one execution along with the arguments.
+    program = CompiledProgram(
+        'n = 0\nwhile n < 100:\n    t = config.settings.rate\n'
+        '    n = n + 1\n')
+    namespace = {'config': ProxyFactory(Config())}
+    for name, maxsize in ('exec-getattr', 0), ('exec-getattr-interned', 1024):
+        counting = ProxyCache(maxsize)
+        ExecutionContext(namespace, proxies=counting).exec_(program)
+        if maxsize:
+            context = ExecutionContext(namespace, proxies=ProxyCache(maxsize))
+        else:
+            context = ExecutionContext(namespace)
+        yield name, counting.created, context.exec_, program
+
+
+def builtin_benchmarks():
+    data = list(range(10))
+    calls = [
+        ('len', (data,)),
+        ('abs', (-1,)),
+        ('min', (3, 1, 2)),
+        ('max', (3, 1, 2)),
+        ('range', (10,)),
+        ('sorted', (data,)),
+    ]
+    for name, args in calls:
+        yield (f'builtin-{name}', getattr(builtins, name), *args)
+        yield (f'builtin-{name}-safe', getattr(SafeBuiltins, name), *args)
+        if name in value_safe_names:
+            yield (f'builtin-{name}-fast', getattr(FastSafeBuiltins, name),
+                   *args)
+    yield 'builtin-import-safe', SafeBuiltins.__import__, 'zope.security'
+    yield 'getattr-safe', SafeBuiltins.getattr, 2 + 1j, 'real'
+    yield 'getattr-guard', guarded_getattr, 2 + 1j, 'real'
+
+
+def import_benchmarks():
+    # Commands starting a new interpreter, the first one is the baseline.
+    yield 'import-none', [sys.executable, '-c', 'pass']
+    for module in ('builtins', 'interpreter'):
+        yield (f'import-{module}',
+               [sys.executable, '-c', f'import zope.untrustedpython.{module}'])
+
+
+def benchmarks():
+    yield from compile_benchmarks()
+    yield from eval_benchmarks()
+    yield from exec_benchmarks()
+    yield from builtin_benchmarks()
+
+
+def add_cmdline_args(cmd, args):
+    if args.select:
+        cmd.extend(['--select', *args.select])
+
+
+def main():
+    runner = pyperf.Runner(add_cmdline_args=add_cmdline_args)
+    runner.argparser.add_argument(
+        '--select', nargs='*', default=(),
+        help='only run benchmarks starting with one of these prefixes')
+    args = runner.parse_args()
+    select = tuple(args.select)
+    for name, func, *func_args in benchmarks():
+        if not select or name.startswith(select):
+            runner.bench_time_func(name, time_calls, func, *func_args)
+    for name, created, func, *func_args in proxy_benchmarks():
+        if not select or name.startswith(select):
+            runner.bench_time_func(name, time_calls, func, *func_args,
+                                   metadata={'proxies_created': created})
+    for name, command in import_benchmarks():
+        if not select or name.startswith(select):
+            runner.bench_command(name, command)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Resource budgets for untrusted code."""
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class BudgetExceeded(Exception):
+    """An execution exceeded its budget."""
+
+
+class ExecutionCancelled(BudgetExceeded):
+    """An execution was cancelled."""
+
+
+class OutputLimitExceeded(BudgetExceeded):
+    """An execution printed more than allowed."""
+
+
+class MemoryLimitExceeded(BudgetExceeded):
+    """An execution allocated more memory than allowed."""
+
+
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+
+
+def _start_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if not _tracemalloc_users and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracemalloc_users = 1
+        elif _tracemalloc_users:
+            _tracemalloc_users += 1
+
+
+def _stop_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users:
+            _tracemalloc_users -= 1
+            if not _tracemalloc_users:
+                tracemalloc.stop()
+
+
+def _codes(code):
+    """Return the ids of `code` and of the code objects nested in it."""
+    ids = {id(code)}
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            ids |= _codes(const)
+    return ids
+
+
+class _Run:
+    """The state of one execution enforcing a budget."""
+
+    def __init__(self, budget, code, globals):
+        self.budget = budget
+        self.codes = _codes(code)
+        self.globals = globals
+        self.start = time.perf_counter()
+        self.elapsed = budget.elapsed
+        self.memory_base = None
+        if budget.memory is not None:
+            _start_tracemalloc()
+            self.memory_base = tracemalloc.get_traced_memory()[0]
+
+    def trace(self, frame, event, arg):
+        if (id(frame.f_code) in self.codes
+                or (self.globals is not None
+                    and frame.f_globals is self.globals)):
+            return self.trace_lines
+        return None
+
+    def trace_lines(self, frame, event, arg):
+        if event == 'line':
+            budget = self.budget
+            with budget._lock:
+                budget.operations_used += 1
+            budget.check()
+            self.check()
+        return self.trace_lines
+
+    def check(self):
+        budget = self.budget
+        if (budget.seconds is not None
+                and (self.elapsed + time.perf_counter() - self.start
+                     > budget.seconds)):
+            raise BudgetExceeded(
+                f'Time budget of {budget.seconds} seconds exceeded')
+        if self.memory_base is not None:
+            used = tracemalloc.get_traced_memory()[0] - self.memory_base
+            with budget._lock:
+                if used > budget.memory_used:
+                    budget.memory_used = used
+            if used > budget.memory:
+                raise MemoryLimitExceeded(
+                    f'Memory budget of {budget.memory} bytes exceeded')
+
+    def finish(self):
+        with self.budget._lock:
+            self.budget.elapsed += time.perf_counter() - self.start
+        if self.memory_base is not None:
+            self.memory_base = None
+            _stop_tracemalloc()
+
+
+class Budget:
+    """Limits on the resources consumed by executions of untrusted code.
+
+    `seconds` limits the wall-clock time, `operations` the number of
+    executed lines of untrusted code and `output` the number of printed
+    characters.  The limits apply to the total of all executions using
+    the budget; `elapsed`, `operations_used` and `output_used` report
+    what was consumed so far.  A budget may be used by concurrent
+    executions; the time of an execution is only added to `elapsed` when
+    it ends, so each one is stopped once the time it ran, plus the time
+    of the executions which ended before it started, exceeds `seconds`.
+
+    `memory` limits the number of bytes each execution may allocate on
+    top of what was allocated when it started; `memory_used` reports the
+    highest amount observed.  Allocations are traced with `tracemalloc`,
+    which is started if needed.  Note that tracemalloc slows down all
+    allocations, that it traces all threads of the process, and that the
+    limit is checked between lines, so a single large allocation is only
+    detected after it succeeded.
+
+    The budget is enforced by a trace function, which only checks frames
+    of the code being executed, including the code nested in it, and of
+    the functions using the globals of the execution, so trusted code
+    called from it is never interrupted.  Untrusted code cannot catch the
+    `BudgetExceeded` raised when a limit is exceeded, as try/except
+    statements are not allowed.
+    """
+
+    def __init__(self, seconds=None, operations=None, output=None,
+                 memory=None):
+        self.seconds = seconds
+        self.operations = operations
+        self.output = output
+        self.memory = memory
+        self.elapsed = 0.0
+        self.operations_used = 0
+        self.output_used = 0
+        self.memory_used = 0
+        self._cancelled = False
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        """Stop executions using the budget at their next line."""
+        self._cancelled = True
+
+    @contextmanager
+    def enforce(self, code, globals=None):
+        """Enforce the budget while `code` runs in the current thread.
+
+        Functions using `globals`, if given, are checked too, so those
+        defined by earlier executions cannot escape the budget.
+        """
+        run = _Run(self, code, globals)
+        old = sys.gettrace()
+        sys.settrace(run.trace)
+        try:
+            yield self
+        finally:
+            sys.settrace(old)
+            run.finish()
+
+    def consume_output(self, size):
+        """Account for `size` printed characters."""
+        with self._lock:
+            self.output_used += size
+            used = self.output_used
+        if self.output is not None and used > self.output:
+            raise OutputLimitExceeded(
+                f'Output budget of {self.output} characters exceeded')
+
+    def check(self):
+        """Raise if the budget was cancelled or its operations used up.
+
+        The time and memory limits are checked by each execution.
+        """
+        if self._cancelled:
+            raise ExecutionCancelled('Execution cancelled')
+        if (self.operations is not None
+                and self.operations_used > self.operations):
+            raise BudgetExceeded(
+                f'Operation budget of {self.operations} exceeded')
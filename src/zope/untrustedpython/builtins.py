@@ -13,18 +13,29 @@
 ##############################################################################
 """Protection of built-in objects.
 """
+import threading
+from sys import modules
 from types import ModuleType
 
-from zope.security.checker import NamesChecker
-from zope.security.proxy import ProxyFactory
 
+# Pure functions whose results are basic objects or their own arguments,
+# so they need no proxy.  They are only left unproxied in
+# `FastSafeBuiltins`.
+value_safe_names = [
+    'abs', 'callable', 'chr', 'divmod', 'hash', 'hex', 'id', 'isinstance',
+    'issubclass', 'len', 'max', 'min', 'oct', 'ord', 'pow', 'repr', 'round',
+]
 
-def SafeBuiltins():
+
+def _safe_builtins(unproxied=(), allowed_imports=None):
 
     safe_builtins = {}
 
     import builtins
 
+    from zope.security.checker import NamesChecker
+    from zope.security.proxy import ProxyFactory
+
     _builtinTypeChecker = NamesChecker(
         ['__str__', '__repr__', '__name__', '__module__',
          '__bases__', '__call__'])
@@ -70,46 +81,112 @@ def SafeBuiltins():
         except AttributeError:
             pass
         else:
-            if isinstance(value, type):
+            if name in unproxied:
+                pass
+            elif isinstance(value, type):
                 value = ProxyFactory(value, _builtinTypeChecker)
             else:
                 value = ProxyFactory(value)
             safe_builtins[name] = value
 
-    from sys import modules
+    safe_builtins['__import__'] = ProxyFactory(
+        Importer(allowed_imports), NamesChecker(['__call__']))
 
-    def _imp(name, fromlist, prefix=''):
-        module = modules.get(prefix + name)
-        if module is not None:
-            if fromlist or ('.' not in name):
-                return module
-            return modules[prefix + name.split('.')[0]]
+    return safe_builtins
 
-    def __import__(name, globals=None, locals=None, fromlist=()):
-        # Waaa, we have to emulate __import__'s weird semantics.
 
-        if globals:
-            __name__ = globals.get('__name__')
-            if __name__:
-                # Maybe do a relative import
-                if '__path__' not in globals:
-                    # We have an ordinary module, not a package,
-                    # so remove last name segment:
-                    __name__ = '.'.join(__name__.split('.')[:-1])
-                if __name__:
-                    module = _imp(name, fromlist, __name__ + '.')
-                    if module is not None:
-                        return module
-
-        module = _imp(name, fromlist)
-        if module is not None:
-            return module
+class Importer:
+    """The ``__import__`` of the safe builtins.
+
+    Only modules which were already imported, i.e. which are in
+    `sys.modules`, can be imported, so no module initialization code is
+    run.  The modules are returned proxied.  Unless the import is
+    explicitly relative, a name is looked up relative to the package of
+    the importing module first.  If `allowed` is given, only the modules
+    it names can be imported; as ``import a.b`` binds ``a``, it needs both
+    ``a`` and ``a.b`` to be allowed, while ``from a.b import c`` only
+    needs ``a.b``.
+
+    Resolutions are cached along with their proxy, keyed by the name of
+    the importing module, the imported name and whether there is a
+    fromlist.  An entry is used as long as the `sys.modules` entries it
+    was resolved from are unchanged.  At most `maxsize` entries are kept.
+    """
+
+    def __init__(self, allowed=None, maxsize=1024):
+        self.allowed = None if allowed is None else frozenset(allowed)
+        self.maxsize = maxsize
+        self._cache = {}
 
+    def __call__(self, name, globals=None, locals=None, fromlist=(),
+                 level=0):
+        if globals:
+            key = (name, not fromlist, level, globals.get('__name__'),
+                   '__path__' in globals)
+        else:
+            key = (name, not fromlist, level, None, False)
+        entry = self._cache.get(key)
+        if entry is not None:
+            proxy, checks = entry
+            for module_name, module in checks:
+                if modules.get(module_name) is not module:
+                    break
+            else:
+                return proxy
+        entry = self._resolve(name, fromlist, level, key[3], key[4])
+        if len(self._cache) >= self.maxsize:
+            self._cache.clear()
+        self._cache[key] = entry
+        return entry[0]
+
+    def _resolve(self, name, fromlist, level, module_name, is_package):
+        """Return the proxied module and the entries it depends on."""
+        from zope.security.proxy import ProxyFactory
+
+        prefixes = []
+        if module_name:
+            package = module_name if is_package else (
+                module_name.rpartition('.')[0])
+            if level > 1:
+                bits = package.rsplit('.', level - 1)
+                if len(bits) < level:
+                    raise ImportError(
+                        'attempted relative import beyond top-level package')
+                package = bits[0]
+            if package:
+                prefixes.append(package + '.')
+        if not level:
+            prefixes.append('')
+        checks = []
+        for prefix in prefixes:
+            module = modules.get(prefix + name)
+            checks.append((prefix + name, module))
+            if module is None:
+                continue
+            if self.allowed is not None and prefix + name not in self.allowed:
+                break
+            if not fromlist and '.' in name:
+                top = prefix + name.partition('.')[0]
+                if self.allowed is not None and top not in self.allowed:
+                    break
+                module = modules[top]
+                checks.append((top, module))
+            return ProxyFactory(module), tuple(checks)
         raise ImportError(name)
 
-    safe_builtins['__import__'] = ProxyFactory(__import__)
+    def clear(self):
+        self._cache.clear()
 
-    return safe_builtins
+
+def make_safe_builtins(allowed_imports=None, fast=False):
+    """Return new safe builtins.
+
+    If `allowed_imports` is given, only the modules it names can be
+    imported.  If `fast` is true, the builtins are those of
+    `FastSafeBuiltins`.
+    """
+    return ImmutableModule(**_safe_builtins(
+        value_safe_names if fast else (), allowed_imports))
 
 
 class ImmutableModule(ModuleType):
@@ -124,4 +201,24 @@ class ImmutableModule(ModuleType):
         raise AttributeError(name)
 
 
-SafeBuiltins = ImmutableModule(**SafeBuiltins())
+# `SafeBuiltins` and its variant `FastSafeBuiltins`, which leaves the
+# builtins named in `value_safe_names` unproxied, are built on first use,
+# so importing this module does not import zope.security.
+_lazy_builtins = {
+    'SafeBuiltins': (),
+    'FastSafeBuiltins': value_safe_names,
+}
+_lock = threading.Lock()
+
+
+def __getattr__(name):
+    try:
+        unproxied = _lazy_builtins[name]
+    except KeyError:
+        raise AttributeError(
+            f'module {__name__!r} has no attribute {name!r}') from None
+    with _lock:
+        module = globals()
+        if name not in module:
+            module[name] = ImmutableModule(**_safe_builtins(unproxied))
+        return module[name]
@@ -0,0 +1,275 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Check untrusted code against the policy without compiling it."""
+import ast
+import symtable
+import threading
+from collections import OrderedDict
+from collections import namedtuple
+from importlib.util import decode_source
+
+from zope.untrustedpython.rcompile import digest
+from zope.untrustedpython.transformer import UntrustedPythonNodeTransformer
+
+
+Diagnostic = namedtuple(
+    'Diagnostic', ['severity', 'rule', 'node', 'line', 'column', 'message'])
+
+# Rules of the policy, identified by the messages of RestrictedPython.
+_rules = (
+    ('statements are not allowed', 'not-allowed'),
+    ('is an invalid variable name', 'invalid-name'),
+    ('is a reserved name', 'reserved-name'),
+    ('is an invalid attribute name', 'invalid-attribute'),
+    ('is a restricted name', 'restricted-attribute'),
+    ('Exec calls are not allowed', 'exec-call'),
+    ('Eval calls are not allowed', 'eval-call'),
+    ('imports are not allowed', 'star-import'),
+    ('Lazy import statements', 'lazy-import'),
+    ('Unpacking in comprehensions', 'comprehension-unpacking'),
+    ('Augmented assignment', 'augmented-assignment'),
+    ('"metaclass"', 'metaclass'),
+    ('Assignment expressions', 'assignment-expression'),
+    ("'printed' variable", 'printed'),
+    ('is not known to RestrictedPython', 'unknown-node'),
+)
+
+
+def _rule(message):
+    for text, rule in _rules:
+        if text in message:
+            return rule
+    return 'policy'
+
+
+def _diagnostic(severity, node, message):
+    return Diagnostic(severity, _rule(message), node.__class__.__name__,
+                      getattr(node, 'lineno', None),
+                      getattr(node, 'col_offset', None), message)
+
+
+_recording_policies = {}
+
+
+def _recording(policy):
+    """Return a subclass of `policy` recording structured diagnostics."""
+    try:
+        return _recording_policies[policy]
+    except KeyError:
+        pass
+
+    class RecordingPolicy(policy):
+
+        def error(self, node, info):
+            self.diagnostics.append(_diagnostic('error', node, info))
+
+        def warn(self, node, info):
+            self.diagnostics.append(_diagnostic('warning', node, info))
+
+    _recording_policies[policy] = RecordingPolicy
+    return RecordingPolicy
+
+
+def _visit(policy, node):
+    """Visit `node`, returning the diagnostics and the print usage."""
+    visitor = _recording(policy)()
+    visitor.diagnostics = []
+    visitor.visit(node)
+    info = visitor.print_info
+    return visitor.diagnostics, info.print_used, info.printed_used
+
+
+class _Context(ast.NodeVisitor):
+    """Raise the errors of statements misplaced, like a ``break``."""
+
+    function = None
+    loop = False
+
+    def _fail(self, node, message):
+        error = SyntaxError(message)
+        error.lineno = node.lineno
+        error.offset = node.col_offset + 1
+        raise error
+
+    def _scope(self, node, function):
+        saved = self.function, self.loop
+        self.function, self.loop = function, False
+        self.generic_visit(node)
+        self.function, self.loop = saved
+
+    def visit_FunctionDef(self, node):
+        self._scope(node, 'def')
+
+    visit_Lambda = visit_FunctionDef
+
+    def visit_AsyncFunctionDef(self, node):
+        self._scope(node, 'async')
+
+    def visit_ClassDef(self, node):
+        self._scope(node, None)
+
+    def visit_For(self, node):
+        loop = self.loop
+        for name, value in ast.iter_fields(node):
+            self.loop = loop or name == 'body'
+            if isinstance(value, list):
+                for item in value:
+                    self.visit(item)
+            elif isinstance(value, ast.AST):
+                self.visit(value)
+        self.loop = loop
+
+    visit_AsyncFor = visit_While = visit_For
+
+    def visit_Return(self, node):
+        if self.function is None:
+            self._fail(node, "'return' outside function")
+        self.generic_visit(node)
+
+    def visit_Yield(self, node):
+        if self.function is None:
+            self._fail(node, "'yield' outside function")
+        self.generic_visit(node)
+
+    visit_YieldFrom = visit_Yield
+
+    def visit_Await(self, node):
+        if self.function is None:
+            self._fail(node, "'await' outside function")
+        if self.function != 'async':
+            self._fail(node, "'await' outside async function")
+        self.generic_visit(node)
+
+    def visit_Break(self, node):
+        if not self.loop:
+            self._fail(node, "'break' outside loop")
+
+    def visit_Continue(self, node):
+        if not self.loop:
+            self._fail(node, "'continue' not properly in loop")
+
+
+def _first_line(node):
+    return min([node.lineno]
+               + [d.lineno for d in getattr(node, 'decorator_list', ())])
+
+
+class Checker:
+    """Thread-safe checker caching its results.
+
+    The diagnostics of whole sources are cached by their digest.  The
+    diagnostics of the top-level statements of a module are cached too,
+    keyed on the source lines of the statement, so when a source changes
+    only the statements which changed are checked again.  Both caches
+    keep at most `maxsize` entries.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._sources = OrderedDict()
+        self._statements = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, entries, key):
+        with self._lock:
+            entry = entries.get(key)
+            if entry is not None:
+                entries.move_to_end(key)
+            return entry
+
+    def _put(self, entries, key, entry):
+        if not self.maxsize:
+            return
+        with self._lock:
+            entries[key] = entry
+            while len(entries) > self.maxsize:
+                entries.popitem(last=False)
+
+    def check(self, source, mode='exec',
+              policy=UntrustedPythonNodeTransformer):
+        """Return the diagnostics of `source` as a tuple of `Diagnostic`.
+
+        No code is generated.  Syntax errors, including those the compiler
+        would raise, like ``return`` outside of a function, and sources
+        which cannot be decoded are reported with the rule ``syntax``.  An
+        empty tuple means the source complies with the policy.
+        """
+        key = (digest(source), mode, policy)
+        diagnostics = self._get(self._sources, key)
+        if diagnostics is None:
+            diagnostics = self._check(source, mode, policy)
+            self._put(self._sources, key, diagnostics)
+        return diagnostics
+
+    def _check(self, source, mode, policy):
+        try:
+            if isinstance(source, bytes):
+                # Honour the encoding declaration, as the compiler does.
+                source = decode_source(source)
+            tree = ast.parse(source, mode=mode)
+            symtable.symtable(source, '<check>', mode)
+            _Context().visit(tree)
+        except SyntaxError as e:
+            return (Diagnostic('error', 'syntax', None, e.lineno,
+                               e.offset and e.offset - 1, e.msg),)
+        except (UnicodeDecodeError, ValueError) as e:
+            # Undecodable bytes, or null bytes before Python 3.12.
+            return (Diagnostic('error', 'syntax', None, None, None,
+                               str(e)),)
+        if mode != 'exec':
+            return tuple(_visit(policy, tree)[0])
+        lines = source.splitlines(keepends=True)
+        diagnostics = []
+        print_used = printed_used = False
+        for node in tree.body:
+            start = _first_line(node)
+            key = (''.join(lines[start - 1:node.end_lineno]),
+                   node.col_offset, node.end_col_offset, policy)
+            entry = self._get(self._statements, key)
+            if entry is None:
+                found, prints, reads = _visit(policy, node)
+                # Store lines relative to the start of the statement, so
+                # the entry stays valid when the statement moves.
+                entry = (tuple(d._replace(line=d.line - start)
+                               if d.line is not None else d
+                               for d in found), prints, reads)
+                self._put(self._statements, key, entry)
+            found, prints, reads = entry
+            diagnostics.extend(d._replace(line=d.line + start)
+                               if d.line is not None else d
+                               for d in found)
+            print_used |= prints
+            printed_used |= reads
+        # The check RestrictingNodeTransformer.visit_Module does last.
+        if print_used and not printed_used:
+            message = "Prints, but never reads 'printed' variable."
+        elif printed_used and not print_used:
+            message = "Doesn't print, but reads 'printed' variable."
+        else:
+            message = None
+        if message is not None:
+            diagnostics.append(_diagnostic('warning', tree, message))
+        return tuple(diagnostics)
+
+    def clear(self):
+        with self._lock:
+            self._sources.clear()
+            self._statements.clear()
+
+
+checker = Checker()
+
+
+def check(source, mode='exec'):
+    return checker.check(source, mode)
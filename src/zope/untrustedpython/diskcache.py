@@ -0,0 +1,141 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Persistent store for restricted code objects.
+
+The code objects are marshalled into a directory, one file per entry.
+Whoever can write to the directory can make the interpreter run
+arbitrary unrestricted code, so it must only be writable by trusted
+users.
+"""
+import hashlib
+import importlib.util
+import marshal
+import os
+import tempfile
+
+import RestrictedPython
+
+
+MAGIC = importlib.util.MAGIC_NUMBER
+
+
+def hash_code(h, code):
+    """Update the hash `h` with the bytecode, names and constants of `code`.
+
+    Nested code objects are hashed recursively.
+    """
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            hash_code(h, const)
+        else:
+            h.update(repr(const).encode())
+
+
+def fingerprint(policy):
+    """Return a digest which changes whenever the policy changes.
+
+    The digest covers the version of RestrictedPython, the bytecode of
+    all methods of `policy` and its bases, and the names provided by
+    `SafeBuiltins`.
+    """
+    from zope.untrustedpython.builtins import SafeBuiltins
+    h = hashlib.sha256()
+    h.update(getattr(RestrictedPython, '__version__', '').encode())
+    for cls in policy.__mro__:
+        if cls is object:
+            continue
+        h.update(f'{cls.__module__}.{cls.__qualname__}'.encode())
+        for name, value in sorted(vars(cls).items()):
+            h.update(name.encode())
+            code = getattr(value, '__code__', None)
+            if code is not None:
+                hash_code(h, code)
+    for name in sorted(SafeBuiltins.__dict__):
+        h.update(name.encode())
+    return h.digest()
+
+
+class DiskCache:
+    """Directory of marshalled restricted code objects.
+
+    An entry is identified by the source digest, the filename, the mode,
+    the magic number of the running Python and the fingerprint of the
+    policy, so entries written by another Python version or for another
+    policy are never loaded.
+    """
+
+    suffix = '.rpyc'
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._fingerprints = {}
+
+    def _header(self, policy):
+        try:
+            fp = self._fingerprints[policy]
+        except KeyError:
+            fp = self._fingerprints[policy] = fingerprint(policy)
+        return MAGIC + fp
+
+    def _path(self, key, header):
+        digest, filename, mode, policy = key
+        name = hashlib.sha256(
+            header + f'\0{digest}\0{filename}\0{mode}'.encode(
+                'utf-8', 'surrogatepass')).hexdigest()
+        return os.path.join(self.directory, name + self.suffix)
+
+    def load(self, key):
+        """Return the ``(code, warnings)`` entry for `key` or None."""
+        header = self._header(key[3])
+        try:
+            with open(self._path(key, header), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if not data.startswith(header):
+            return None
+        try:
+            code, warnings = marshal.loads(data[len(header):])
+        except (EOFError, ValueError, TypeError):
+            return None
+        return code, tuple(warnings)
+
+    def dump(self, key, entry):
+        """Store the ``(code, warnings)`` entry for `key`.
+
+        Failures to write are ignored, the cache is only an optimization.
+        """
+        header = self._header(key[3])
+        code, warnings = entry
+        data = header + marshal.dumps((code, tuple(warnings)))
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.directory)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, self._path(key, header))
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except OSError:
+            pass
+
+    def clear(self):
+        """Remove all entries."""
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix):
+                os.unlink(os.path.join(self.directory, name))
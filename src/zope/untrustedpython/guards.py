@@ -0,0 +1,92 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Guards called by restricted code."""
+from zope.security.checker import ProxyFactory
+from zope.security.proxy import Proxy
+from zope.security.proxy import getChecker
+from zope.security.proxy import removeSecurityProxy
+
+
+def guarded_getattr(object, name):
+    """The ``_getattr_`` guard.
+
+    This is equivalent to calling the proxied ``getattr`` of the safe
+    builtins, without the overhead of calling through a proxy: the
+    attribute of a proxied object is checked by its proxy, and the result
+    is proxied unless it is a basic object.
+    """
+    return ProxyFactory(getattr(object, name))
+
+
+class ProxyCache:
+    """Proxies interned by the identity of the objects they wrap.
+
+    Each access to an object through `getattr` normally creates a new
+    proxy, which code accessing the same objects in a loop pays for with
+    many short-lived allocations.  `getattr` is a ``_getattr_`` guard
+    returning the same proxy for the same object instead; pass the cache
+    to an `ExecutionContext` to use it.
+
+    At most `maxsize` proxies are kept, the oldest one is dropped first.
+    As a proxy references its object, the object stays alive while its
+    proxy is cached and its id cannot be reused.  `created` counts the
+    proxies created and `reused` those returned from the cache.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.created = 0
+        self.reused = 0
+        self._proxies = {}
+
+    def proxy(self, value, checker=None):
+        """Return the proxy of `value`, `value` if it is not proxied.
+
+        If `checker` is given, the proxy is made by its ``proxy`` method,
+        like a proxy guarded by `checker` makes the proxies of the values
+        it returns.
+        """
+        key = id(value) if checker is None else (id(value), checker)
+        proxy = self._proxies.get(key)
+        if proxy is not None:
+            self.reused += 1
+            return proxy
+        if checker is None:
+            proxy = ProxyFactory(value)
+        else:
+            proxy = checker.proxy(value)
+        if proxy is value:
+            return value
+        self.created += 1
+        if self.maxsize:
+            proxies = self._proxies
+            if len(proxies) >= self.maxsize:
+                try:
+                    del proxies[next(iter(proxies))]
+                except (KeyError, RuntimeError, StopIteration):
+                    pass
+            proxies[key] = proxy
+        return proxy
+
+    def getattr(self, object, name):
+        """The ``_getattr_`` guard, see `guarded_getattr`."""
+        if type(object) is Proxy:
+            checker = getChecker(object)
+            unproxied = removeSecurityProxy(object)
+            checker.check_getattr(unproxied, name)
+            return self.proxy(getattr(unproxied, name), checker)
+        return self.proxy(getattr(object, name))
+
+    def clear(self):
+        self._proxies.clear()
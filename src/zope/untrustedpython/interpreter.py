@@ -13,51 +13,624 @@
 ##############################################################################
 """Restricted interpreter."""
 # TODO: This code needs a serious security review!!!
+import dis
+import functools
+import hashlib
+import marshal
+import pickle
+import weakref
+from collections import ChainMap
+from collections import namedtuple
+from types import CodeType
+from types import SimpleNamespace
+
 from RestrictedPython.PrintCollector import PrintCollector
 
 from zope.untrustedpython import rcompile
-from zope.untrustedpython.builtins import SafeBuiltins
+from zope.untrustedpython.budget import Budget
+from zope.untrustedpython.printing import OutputCollector
+from zope.untrustedpython.printing import PrintStream
+
+
+class _LazySecurity:
+    """The safe builtins and the guards, imported on first use.
+
+    They import zope.security, which is only needed once untrusted code
+    runs, so importing this module stays cheap.  On first use, this object
+    replaces itself by a plain namespace, keeping later lookups fast.
+    """
+
+    def __getattr__(self, name):
+        global _security
+        from zope.untrustedpython.builtins import SafeBuiltins
+        from zope.untrustedpython.guards import guarded_getattr
+        _security = SimpleNamespace(SafeBuiltins=SafeBuiltins,
+                                    guarded_getattr=guarded_getattr)
+        return getattr(_security, name)
+
+
+_security = _LazySecurity()
+
+
+def __getattr__(name):
+    # `SafeBuiltins` and `guarded_getattr` used to be imported here.
+    if name in ('SafeBuiltins', 'guarded_getattr'):
+        return getattr(_security, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def _run(run, code, globals, locals, budget):
+    """Call `run`, i.e. exec or eval, enforcing `budget` if given."""
+    if budget is None:
+        return run(code, globals, locals)
+    with budget.enforce(code, globals):
+        return run(code, globals, locals)
+
+
+def _run_profiled(run, code, globals, locals, budget, profile):
+    """Call `_run` with the instrumentation of `profile` installed."""
+    with profile.measure('setup'):
+        saved = profile.install(globals)
+    try:
+        with profile.measure('exec'), profile.sampling(code):
+            return _run(run, code, globals, locals, budget)
+    finally:
+        profile.restore(globals, saved)
+
+
+def exec_code(code, globals, locals=None, budget=None, profile=None):
+    globals['__builtins__'] = _security.SafeBuiltins
+    globals['_getattr_'] = _security.guarded_getattr
+    if profile is None:
+        _run(exec, code, globals, locals, budget)
+    else:
+        try:
+            _run_profiled(exec, code, globals, locals, budget, profile)
+        finally:
+            profile.finish()
+
+
+def exec_src(source, globals, locals=None, budget=None, profile=None):
+    if profile is None:
+        code = rcompile.compile(source, '<string>', 'exec')
+    else:
+        with profile.measure('compile'):
+            code = rcompile.compile(source, '<string>', 'exec')
+    exec_code(code, globals, locals, budget, profile)
+
+
+class AsyncRunner:
+    """Run untrusted code from asyncio without blocking the event loop.
+
+    The work is offloaded to `executor`, the default executor of the
+    running loop if None.  If `limit` is given, at most `limit` calls run
+    at the same time, further calls wait for a free slot.
+
+    Note that cancelling a call or exceeding its `timeout` only abandons
+    the call: Python threads cannot be interrupted, so code which already
+    started keeps running in its thread until it ends, holding its slot.
+    The asynchronous methods of compiled code therefore run with a
+    `Budget`, which stops the code cooperatively.
+    """
+
+    def __init__(self, executor=None, limit=None):
+        self.executor = executor
+        self._semaphore = None
+        if limit:
+            import asyncio
+            self._semaphore = asyncio.Semaphore(limit)
+
+    async def run(self, func, *args, timeout=None, **kw):
+        """Call ``func(*args, **kw)`` in the executor.
+
+        Raise `TimeoutError` if the call does not end within `timeout`
+        seconds, waiting for a free slot included.
+        """
+        import asyncio
+        return await asyncio.wait_for(self._run(func, args, kw), timeout)
+
+    async def _run(self, func, args, kw):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        call = functools.partial(func, *args, **kw)
+        if self._semaphore is None:
+            return await loop.run_in_executor(self.executor, call)
+        semaphore = self._semaphore
+        await semaphore.acquire()
+        try:
+            future = loop.run_in_executor(self.executor, call)
+        except BaseException:
+            semaphore.release()
+            raise
+        # The slot is released when the call ends, not when it is
+        # abandoned, as its thread keeps running the code until then.
+        future.add_done_callback(lambda future: semaphore.release())
+        return await asyncio.shield(future)
+
+
+default_runner = AsyncRunner()
+
+
+async def _arun(func, args, runner, timeout, budget):
+    """Run ``func(*args, budget)`` with `runner`.
+
+    The budget is cancelled if the call is abandoned, which stops the code
+    at its next line.  If a `timeout` but no `budget` is given, a budget
+    without limits is used for this purpose.
+    """
+    runner = default_runner if runner is None else runner
+    if budget is None and timeout is not None:
+        budget = Budget()
+    try:
+        return await runner.run(func, *args, budget, timeout=timeout)
+    except BaseException:
+        if budget is not None:
+            budget.cancel()
+        raise
+
+
+def _exec_printing(code, globals, locals, output, budget, buffer_size,
+                   profile=None):
+    """Execute `code`, writing the printed text to `output`.
+
+    See `CompiledProgram.exec_`.
+    """
+    streaming = buffer_size is not None or (
+        budget is not None and budget.output is not None)
+    if streaming:
+        stream = PrintStream(output, buffer_size or 0, budget)
+        globals['_print_'] = functools.partial(
+            OutputCollector, stream=stream, retain=buffer_size is None)
+    else:
+        globals['_print_'] = PrintCollector
+    if profile is None:
+        try:
+            _run(exec, code, globals, locals, budget)
+        finally:
+            if streaming:
+                stream.flush()
+        if output is not None and not streaming:
+            output.write(globals['_print']())
+        return
+    try:
+        try:
+            _run_profiled(exec, code, globals, locals, budget, profile)
+        finally:
+            if streaming:
+                with profile.measure('flush'):
+                    stream.flush()
+        if output is not None and not streaming:
+            with profile.measure('flush'):
+                output.write(globals['_print']())
+    finally:
+        profile.finish()
+
+
+async def aexec_src(source, globals, locals=None, runner=None, timeout=None,
+                    budget=None):
+    """Asynchronous version of `exec_src`."""
+    await _arun(exec_src, (source, globals, locals), runner, timeout, budget)
+
+
+def _guard_names(code):
+    """Return the guard names used by the expression `code`.
+
+    Return None if `code` assigns names or contains nested scopes, as it
+    then cannot be evaluated with the caller's values as locals.
+    """
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            return None
+    for instruction in dis.get_instructions(code):
+        if instruction.opname in ('STORE_NAME', 'DELETE_NAME'):
+            return None
+    return tuple(name for name in code.co_names if name.startswith('_'))
+
+
+# The globals of pure expressions, which need no builtins.
+_pure_globals = {'__builtins__': {}}
+
+# Weak references to the code objects of compiled code, by their hash.
+_interned_codes = {}
+
+
+def _identical(code, other):
+    """Tell whether the code objects only differ by their identity.
+
+    Code objects compiled from sources differing only in their layout may
+    be equal, but their line numbers differ.
+    """
+    return (code == other and code.co_filename == other.co_filename
+            and code.co_linetable == other.co_linetable
+            and all(_identical(const, other_const) for const, other_const
+                    in zip(code.co_consts, other.co_consts)
+                    if isinstance(const, CodeType)))
+
+
+def _intern(code):
+    """Return the interned code object identical to `code`."""
+    key = hash(code)
+    ref = _interned_codes.get(key)
+    if ref is not None:
+        interned = ref()
+        if interned is not None and _identical(interned, code):
+            return interned
+
+    def forget(ref):
+        if _interned_codes.get(key) is ref:
+            _interned_codes.pop(key, None)
+
+    _interned_codes[key] = weakref.ref(code, forget)
+    return code
+
+
+@functools.lru_cache(maxsize=None)
+def _fingerprint():
+    """Identify the Python version and the policy code is compiled for."""
+    from zope.untrustedpython import diskcache
+    from zope.untrustedpython import transformer
+    h = hashlib.sha256(diskcache.MAGIC)
+    h.update(diskcache.fingerprint(
+        transformer.UntrustedPythonNodeTransformer))
+    diskcache.hash_code(h, rcompile.pure_expression.__code__)
+    return h.digest()
+
 
+class _Compiled:
+    """Base class of compiled code.
 
-def exec_code(code, globals, locals=None):
-    globals['__builtins__'] = SafeBuiltins
-    globals['_getattr_'] = SafeBuiltins.getattr
-    exec(code, globals, locals)
+    Instances have no `__dict__`, and identical code objects are shared
+    by all instances.  `drop_source` releases the source of instances
+    which are kept for a long time.
 
+    Pickles hold the marshalled code and a fingerprint of the Python
+    version and of the policy, so unpickling does not compile the source
+    again unless they changed.  Code without source cannot be unpickled
+    then.
+    """
 
-def exec_src(source, globals, locals=None):
-    code = rcompile.compile(source, '<string>', 'exec')
-    exec_code(code, globals, locals)
+    __slots__ = ('_source', '_loader', 'code', '__weakref__')
 
+    # The names of the slots making up the state, besides the code.
+    _state = ('_source', '_loader')
 
-class CompiledExpression:
-    """A compiled expression."""
+    @property
+    def source(self):
+        """The source, reloaded if it was dropped with a loader."""
+        source = self._source
+        if source is None and self._loader is not None:
+            return self._loader()
+        return source
+
+    @source.setter
+    def source(self, source):
+        self._source = source
+        self._loader = None
+
+    def drop_source(self, loader=None):
+        """Release the source.
+
+        `loader`, if given, is called without arguments to reload the
+        source whenever `source` is accessed, e.g. from a database.  It is
+        pickled along with the compiled code.
+        """
+        self._source = None
+        self._loader = loader
+
+    def __getstate__(self):
+        code = self.code
+        return (_fingerprint(), code.co_filename, marshal.dumps(code),
+                *[getattr(self, name) for name in self._state])
+
+    def __setstate__(self, state):
+        fingerprint, filename, data, *values = state
+        for name, value in zip(self._state, values):
+            setattr(self, name, value)
+        if fingerprint == _fingerprint():
+            self.code = _intern(marshal.loads(data))
+            return
+        loader = self._loader
+        source = self.source
+        if source is None:
+            raise pickle.UnpicklingError(
+                'The code was compiled for another Python version or policy'
+                ' and its source was dropped.')
+        self.__init__(source, filename)
+        if loader is not None:
+            self.drop_source(loader)
+
+
+class CompiledExpression(_Compiled):
+    """A compiled expression.
+
+    Pure expressions, see `zope.untrustedpython.rcompile.pure_expression`,
+    are compiled without the restricting transform and evaluated without
+    builtins and guards; the values are looked up in the globals given by
+    the caller, which are left unchanged.  `pure` tells whether the
+    expression is pure.
+    """
+
+    __slots__ = ('pure', '_guards')
+
+    _state = _Compiled._state + __slots__
 
     def __init__(self, source, filename='<string>'):
         self.source = source
-        self.code = rcompile.compile(source, filename, 'eval')
-
-    def eval(self, globals, locals=None):
-        globals['__builtins__'] = SafeBuiltins
-        globals['_getattr_'] = SafeBuiltins.getattr
-        if locals is None:
-            return eval(self.code, globals)
+        code = rcompile.compile_pure(source, filename)
+        self.pure = code is not None
+        if code is None:
+            code = rcompile.compile(source, filename, 'eval')
+            self._guards = _guard_names(code)
         else:
-            return eval(self.code, globals, locals)
+            self._guards = ()
+        self.code = _intern(code)
+
+    def eval(self, globals, locals=None, budget=None):
+        if self.pure:
+            if locals is not None:
+                globals = ChainMap(locals, globals)
+            return _run(eval, self.code, _pure_globals, globals, budget)
+        globals['__builtins__'] = _security.SafeBuiltins
+        globals['_getattr_'] = _security.guarded_getattr
+        return _run(eval, self.code, globals, locals, budget)
+
+    async def aeval(self, globals, locals=None, runner=None, timeout=None,
+                    budget=None):
+        """Asynchronous version of `eval`, see `AsyncRunner`."""
+        return await _arun(
+            self.eval, (globals, locals), runner, timeout, budget)
+
+    def eval_many(self, namespaces, collect_errors=False):
+        """Evaluate the expression once for each of `namespaces`.
 
+        The restricted globals are prepared once and layered under each
+        namespace, so the namespaces themselves are not modified.  The
+        results are generated lazily.  If `collect_errors` is true, an
+        exception raised by one evaluation is generated in place of its
+        result instead of aborting the batch.
+        """
+        code = self.code
+        if self.pure:
+            for namespace in namespaces:
+                try:
+                    result = eval(code, _pure_globals, namespace)
+                except Exception as e:
+                    if not collect_errors:
+                        raise
+                    result = e
+                yield result
+            return
+        template = {'__builtins__': _security.SafeBuiltins,
+                    '_getattr_': _security.guarded_getattr}
+        for namespace in namespaces:
+            globals = dict(namespace)
+            globals.update(template)
+            try:
+                result = eval(code, globals)
+            except Exception as e:
+                if not collect_errors:
+                    raise
+                result = e
+            yield result
 
-class CompiledProgram:
+    def eval_columns(self, columns):
+        """Evaluate the expression for each row of `columns`.
+
+        `columns` maps names to sequences of the same length, the values
+        of a name in successive rows.  Return the results as a list, or
+        as a NumPy array if the columns used are arrays.  Expressions
+        made only of arithmetic, comparisons and boolean operators over
+        names and literals are evaluated over whole columns, see
+        `zope.untrustedpython.vectorized`; other ones row by row.
+        """
+        from zope.untrustedpython import vectorized
+        return vectorized.evaluate(self, columns)
+
+
+class CompiledProgram(_Compiled):
     """A compiled program."""
 
+    __slots__ = ()
+
     def __init__(self, source, filename='<string>'):
         self.source = source
-        self.code = rcompile.compile(source, filename, 'exec')
+        self.code = _intern(rcompile.compile(source, filename, 'exec'))
 
-    def exec_(self, globals, locals=None, output=None):
-        globals['__builtins__'] = SafeBuiltins
-        globals['_print_'] = PrintCollector
-        globals['_getattr_'] = SafeBuiltins.getattr
+    def exec_(self, globals, locals=None, output=None, budget=None,
+              buffer_size=None, profile=None):
+        """Execute the program.
 
-        exec(self.code, globals, locals)
-        if output is not None:
-            output.write(globals['_print']())
+        The printed text is written to `output` when the program ends.  If
+        `buffer_size` is given, the text is written to `output` whenever
+        that many characters were printed instead, and it is not kept in
+        memory for the ``printed`` variable.  If `budget` limits the
+        output, the text is written to `output` while it is printed.  If a
+        `zope.untrustedpython.profiling.Profile` is given, the execution
+        is instrumented and its statistics are added to the profile.
+        """
+        globals['__builtins__'] = _security.SafeBuiltins
+        globals['_getattr_'] = _security.guarded_getattr
+        _exec_printing(self.code, globals, locals, output, budget, buffer_size,
+                       profile)
+
+    async def aexec(self, globals, locals=None, output=None, runner=None,
+                    timeout=None, budget=None, buffer_size=None):
+        """Asynchronous version of `exec_`, see `AsyncRunner`.
+
+        Use a `zope.untrustedpython.printing.QueueWriter` as `output` to
+        consume the printed text while the program runs.
+        """
+        await _arun(
+            functools.partial(self.exec_, buffer_size=buffer_size),
+            (globals, locals, output), runner, timeout, budget)
+
+
+class ExecutionContext:
+    """Restricted globals prepared once for many executions.
+
+    The restricted builtins and the trusted values of `namespace`, for
+    example helper functions, are stored in a frozen base namespace.  The
+    values passed to a call take precedence over the trusted values, but
+    not over the restricted builtins and guards.  Neither the base nor the
+    caller's values are modified, so one context can be used by many
+    threads at the same time.
+
+    Compiled expressions which neither assign names nor contain nested
+    scopes are evaluated with the base as globals and the values as
+    locals, so no namespace needs to be built at all.  Other code gets a
+    shallow copy of the base updated with the values.
+
+    `builtins` is the builtins module of the executions, `SafeBuiltins`
+    if None.  Pass `zope.untrustedpython.builtins.FastSafeBuiltins` to
+    call the pure builtins without going through security proxies.  If a
+    `zope.untrustedpython.guards.ProxyCache` is given as `proxies`, the
+    attributes accessed by the executions are proxied through it.
+    """
+
+    def __init__(self, namespace=None, builtins=None, proxies=None):
+        if builtins is None:
+            builtins = _security.SafeBuiltins
+        getattr_ = (_security.guarded_getattr if proxies is None
+                    else proxies.getattr)
+        self._protected = {'__builtins__': builtins,
+                           '_getattr_': getattr_,
+                           '_print_': PrintCollector}
+        base = dict(namespace or ())
+        base.update(self._protected)
+        self._base = base
+
+    def namespace(self, values=None):
+        """Return a new globals dict holding `values`."""
+        globals = self._base.copy()
+        if values:
+            globals.update(values)
+            globals.update(self._protected)
+        return globals
+
+    def eval(self, expression, values=None, budget=None):
+        """Evaluate a `CompiledExpression` or a code object."""
+        code = getattr(expression, 'code', expression)
+        guards = getattr(expression, '_guards', None)
+        if guards is not None and values is not None:
+            for name in guards:
+                if name in values:
+                    break
+            else:
+                if budget is None:
+                    return eval(code, self._base, values)
+                return _run(eval, code, self._base, values, budget)
+        return _run(eval, code, self.namespace(values), None, budget)
+
+    def exec_(self, program, values=None, output=None, budget=None,
+              buffer_size=None, profile=None):
+        """Execute a `CompiledProgram` or a code object.
+
+        Return the resulting namespace.  See `CompiledProgram.exec_` for
+        the other arguments.
+        """
+        code = getattr(program, 'code', program)
+        globals = self.namespace(values)
+        _exec_printing(code, globals, None, output, budget, buffer_size,
+                       profile)
+        return globals
+
+
+ExecutionResult = namedtuple('ExecutionResult', ['namespace', 'output'])
+
+# Names installed into the globals by the interpreter.
+_installed_names = frozenset(
+    ['__builtins__', '_getattr_', '_print_', '_print'])
+
+# Code objects known to a pool worker, keyed by content hash.
+_worker_codes = {}
+
+
+def _init_worker(codes):
+    # Import the safe builtins before the first request comes in.
+    _security.SafeBuiltins
+    for key, data in codes.items():
+        _worker_codes[key] = marshal.loads(data)
+
+
+def _exec_in_worker(key, data, globals, names, budget=None):
+    code = _worker_codes.get(key)
+    if code is None:
+        code = _worker_codes[key] = marshal.loads(data)
+    return _execute(code, globals, names, budget)
+
+
+def _execute(code, globals, names, budget=None):
+    """Execute `code`, return the picklable values of `names`."""
+    globals['__builtins__'] = _security.SafeBuiltins
+    globals['_print_'] = PrintCollector
+    globals['_getattr_'] = _security.guarded_getattr
+    _run(exec, code, globals, None, budget)
+    printed = globals.get('_print')
+    output = printed() if printed is not None else ''
+    if names is None:
+        names = [name for name in globals if name not in _installed_names]
+    namespace = {}
+    for name in names:
+        if name not in globals:
+            continue
+        value = globals[name]
+        try:
+            pickle.dumps(value)
+        except Exception:
+            continue
+        namespace[name] = value
+    return ExecutionResult(namespace, output)
+
+
+class ProcessPoolRunner:
+    """Execute compiled programs in a pool of worker processes.
+
+    The workers import the safe builtins once when they start.  Code
+    objects are shipped as marshalled bytecode identified by a content
+    hash; the code of the `programs` passed to the constructor is shipped
+    to every worker on start, other code is shipped along with every
+    request for it, and each worker unmarshals it once.
+
+    `submit` returns a future whose result is an `ExecutionResult` holding
+    the resulting namespace and the printed output.
+    """
+
+    def __init__(self, max_workers=None, programs=(), mp_context=None):
+        from concurrent.futures import ProcessPoolExecutor
+        self._marshalled = {}
+        preshipped = dict(self._marshal(p.code) for p in programs)
+        self._preshipped = frozenset(preshipped)
+        self._executor = ProcessPoolExecutor(
+            max_workers, mp_context=mp_context,
+            initializer=_init_worker, initargs=(preshipped,))
+
+    def _marshal(self, code):
+        try:
+            return self._marshalled[code]
+        except KeyError:
+            data = marshal.dumps(code)
+            entry = hashlib.sha256(data).hexdigest(), data
+            self._marshalled[code] = entry
+            return entry
+
+    def submit(self, program, globals=None, names=None, budget=None):
+        """Execute `program` in a worker, with `budget` if given.
+
+        Only the picklable values of the resulting namespace are returned,
+        restricted to `names` if given.  Names missing from the namespace
+        are skipped.
+        """
+        key, data = self._marshal(program.code)
+        if key in self._preshipped:
+            data = None
+        return self._executor.submit(
+            _exec_in_worker, key, data, dict(globals or {}), names, budget)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
@@ -0,0 +1,83 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Print collectors for untrusted code."""
+from RestrictedPython.PrintCollector import PrintCollector
+
+
+class PrintStream:
+    """Buffered sink for the text printed by an execution.
+
+    The text is written to `output` as soon as at least `buffer_size`
+    characters are buffered, and when the stream is flushed.  The text is
+    accounted against the output limit of `budget` before it is buffered.
+    """
+
+    def __init__(self, output=None, buffer_size=0, budget=None):
+        self.output = output
+        self.buffer_size = buffer_size
+        self.budget = budget
+        self._buffer = []
+        self._size = 0
+
+    def write(self, text):
+        if self.budget is not None:
+            self.budget.consume_output(len(text))
+        self._buffer.append(text)
+        self._size += len(text)
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            text = ''.join(self._buffer)
+            self._buffer = []
+            self._size = 0
+            if self.output is not None:
+                self.output.write(text)
+
+
+class QueueWriter:
+    """File-like adapter putting the written text into a queue.
+
+    If `loop` is given, `queue` is an `asyncio.Queue` of that loop, which
+    may be written to from another thread.
+    """
+
+    def __init__(self, queue, loop=None):
+        self.queue = queue
+        self.loop = loop
+
+    def write(self, text):
+        if self.loop is None:
+            self.queue.put_nowait(text)
+        else:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, text)
+
+
+class OutputCollector(PrintCollector):
+    """Print collector writing to a `PrintStream`.
+
+    The text is kept for the ``printed`` variable only if `retain` is
+    true; otherwise ``printed`` evaluates to the empty string.
+    """
+
+    def __init__(self, _getattr_=None, stream=None, retain=True):
+        PrintCollector.__init__(self, _getattr_)
+        self.stream = stream
+        self.retain = retain
+
+    def write(self, text):
+        self.stream.write(text)
+        if self.retain:
+            self.txt.append(text)
@@ -0,0 +1,174 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Instrumentation of executions of untrusted code."""
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+phases = ('compile', 'setup', 'exec', 'flush')
+
+# The names of the globals replaced by `Profile.install`.
+_installed = ('__builtins__', '_getattr_')
+
+_marker = object()
+
+
+def _counting(name, function, counts):
+    def call(*args, **kw):
+        counts[name] += 1
+        return function(*args, **kw)
+    return call
+
+
+class _Sampler(threading.Thread):
+    """Sample the line of `filename` running in the thread `thread_id`."""
+
+    def __init__(self, lines, filename, thread_id, interval):
+        threading.Thread.__init__(self, daemon=True)
+        self.lines = lines
+        self.filename = filename
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            while frame is not None:
+                if frame.f_code.co_filename == self.filename:
+                    self.lines[self.filename, frame.f_lineno] += 1
+                    break
+                frame = frame.f_back
+
+
+class Profile:
+    """Statistics of the executions it is passed to.
+
+    `timings` maps the phases of an execution, see `phases`, to the
+    seconds spent in them; the ``compile`` phase is only measured by
+    functions compiling the source themselves, like `exec_src`.
+    `getattr_calls` counts the calls of the ``_getattr_`` guard by
+    attribute name and `builtin_calls` the calls of builtin functions by
+    name; calls of builtin types are not counted.
+
+    If a sampling `interval` in seconds is given, a thread samples the
+    executing line of the untrusted code at that interval; `lines` maps
+    ``(filename, line)`` to the number of samples.  `callback` is called
+    with the profile after each execution.
+
+    Counting and sampling slow the execution down, so a profile should
+    only be used to find hot spots.
+    """
+
+    def __init__(self, interval=None, callback=None):
+        self.interval = interval
+        self.callback = callback
+        self.executions = 0
+        self.timings = dict.fromkeys(phases, 0.0)
+        self.getattr_calls = Counter()
+        self.builtin_calls = Counter()
+        self.lines = Counter()
+        self._builtins = {}
+
+    @contextmanager
+    def measure(self, phase):
+        """Add the time spent in the block to `phase`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[phase] += time.perf_counter() - start
+
+    def install(self, globals):
+        """Replace the builtins and the guard by counting ones.
+
+        Return the replaced values, to be passed to `restore`.
+        """
+        from zope.security.proxy import ProxyFactory
+        from zope.security.proxy import removeSecurityProxy
+
+        from zope.untrustedpython.builtins import ImmutableModule
+        from zope.untrustedpython.guards import guarded_getattr
+
+        saved = {name: globals.get(name, _marker) for name in _installed}
+        builtins = globals['__builtins__']
+        counting = self._builtins.get(builtins)
+        if counting is None:
+            values = {}
+            for name, value in vars(builtins).items():
+                if (name not in ('__name__', '__doc__', '__package__',
+                                 '__loader__', '__spec__')
+                        and callable(value)
+                        and not isinstance(removeSecurityProxy(value),
+                                           type)):
+                    value = ProxyFactory(
+                        _counting(name, value, self.builtin_calls))
+                values[name] = value
+            counting = ImmutableModule(**values)
+            self._builtins[builtins] = counting
+        globals['__builtins__'] = counting
+        getattr_calls = self.getattr_calls
+
+        def _getattr_(object, name):
+            getattr_calls[name] += 1
+            return guarded_getattr(object, name)
+
+        globals['_getattr_'] = _getattr_
+        return saved
+
+    def restore(self, globals, saved):
+        """Put back the values replaced by `install`."""
+        for name, value in saved.items():
+            if value is _marker:
+                globals.pop(name, None)
+            else:
+                globals[name] = value
+
+    @contextmanager
+    def sampling(self, code):
+        """Sample the lines of `code` executed in the block."""
+        if self.interval is None:
+            yield
+            return
+        sampler = _Sampler(self.lines, code.co_filename,
+                           threading.get_ident(), self.interval)
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stopped.set()
+            sampler.join()
+
+    def finish(self):
+        """Count an execution and report it to the callback.
+
+        Failed executions are counted too.
+        """
+        self.executions += 1
+        if self.callback is not None:
+            self.callback(self)
+
+    def stats(self):
+        """Return the statistics as a dict of basic objects."""
+        return {
+            'executions': self.executions,
+            'timings': dict(self.timings),
+            'getattr_calls': dict(self.getattr_calls),
+            'builtin_calls': dict(self.builtin_calls),
+            'lines': [[filename, line, samples] for (filename, line), samples
+                      in self.lines.most_common()],
+        }
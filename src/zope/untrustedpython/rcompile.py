@@ -12,11 +12,313 @@
 #
 ##############################################################################
 """compile() equivalent that produces restricted code."""
-from RestrictedPython import compile_restricted
+import ast
+import builtins
+import functools
+import hashlib
+import marshal
+import threading
+import warnings
+from collections import OrderedDict
+from collections import namedtuple
+
+from RestrictedPython import compile_restricted_eval
+from RestrictedPython import compile_restricted_exec
+from RestrictedPython import compile_restricted_single
+from RestrictedPython.transformer import FORBIDDEN_FUNC_NAMES
 
 from zope.untrustedpython.transformer import UntrustedPythonNodeTransformer
 
 
+_compilers = {
+    'exec': compile_restricted_exec,
+    'eval': compile_restricted_eval,
+    'single': compile_restricted_single,
+}
+
+CacheInfo = namedtuple(
+    'CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+# `filename`, `mode` and `policy` are those the source was compiled with.
+BulkResult = namedtuple(
+    'BulkResult',
+    ['digest', 'code', 'errors', 'warnings', 'filename', 'mode', 'policy'],
+    defaults=(None, None, None))
+
+
+def digest(source):
+    """Return the hex digest used to identify `source` in caches.
+
+    Returns None for sources which cannot be cached, e.g. AST nodes.
+    """
+    if isinstance(source, str):
+        source = source.encode('utf-8', 'surrogatepass')
+    elif isinstance(source, (bytes, bytearray)):
+        # Bytes may carry an encoding declaration, keep them apart from text.
+        source = b'b:' + source
+    else:
+        return None
+    return hashlib.sha256(source).hexdigest()
+
+
+# The nodes of pure expressions, see `pure_expression`.
+_pure_nodes = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.BoolOp,
+    ast.Name, ast.Constant, ast.Load,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+    ast.UAdd, ast.USub, ast.Not, ast.And, ast.Or,
+    ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+)
+
+
+def pure_expression(source):
+    """Return the AST of `source` if it is a pure expression, else None.
+
+    A pure expression only applies arithmetic, comparison and boolean
+    operators to names and literals, so it can neither access attributes
+    nor call anything, and the restricting transform leaves it unchanged.
+    Names of builtins and names the policy rejects are not pure.
+    """
+    try:
+        tree = ast.parse(source, mode='eval')
+    except (SyntaxError, ValueError, TypeError):
+        return None
+    for node in ast.walk(tree):
+        if not isinstance(node, _pure_nodes):
+            return None
+        if isinstance(node, ast.Name):
+            name = node.id
+            if (name.startswith('_') or name.endswith('__roles__')
+                    or name in FORBIDDEN_FUNC_NAMES
+                    or hasattr(builtins, name)):
+                return None
+    return tree
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile_pure(source, filename):
+    tree = pure_expression(source)
+    return None if tree is None else builtins.compile(tree, filename, 'eval')
+
+
+def compile_pure(source, filename='<string>'):
+    """Compile `source` if it is a pure expression, else return None.
+
+    The code is compiled without the restricting transform; it must be
+    evaluated without builtins.  Results are cached.
+    """
+    if not isinstance(source, (str, bytes)):
+        return None
+    return _compile_pure(source, filename)
+
+
+def _compile(source, filename, mode, policy):
+    """Compile `source` returning the code and the policy warnings."""
+    try:
+        compiler = _compilers[mode]
+    except KeyError:
+        raise TypeError('unknown mode %s' % mode)
+    result = compiler(source, filename, policy=policy)
+    if result.errors:
+        raise SyntaxError(result.errors)
+    return result.code, tuple(result.warnings)
+
+
+def _compile_marshalled(source, filename, mode, policy):
+    """Compile `source` in a worker process.
+
+    Code objects cannot be pickled, so the code is returned marshalled.
+    """
+    result = _compilers[mode](source, filename, policy=policy)
+    code = None if result.code is None else marshal.dumps(result.code)
+    return code, tuple(result.errors), tuple(result.warnings)
+
+
+class CompileCache:
+    """Thread-safe LRU cache of restricted code objects.
+
+    Entries are keyed on the digest of the source, the filename, the mode
+    and the policy class.  Code objects are immutable, so a cached code
+    object can be shared by all callers.  Sources which fail to compile
+    are not cached.  Warnings of the policy are emitted again on every
+    cache hit, so a cached compile behaves like an uncached one.
+
+    A `maxsize` of 0 disables caching.  If a `store` such as a
+    `zope.untrustedpython.diskcache.DiskCache` is given, it is consulted
+    before compiling and is updated with every newly compiled entry.
+    """
+
+    def __init__(self, maxsize=1024, store=None):
+        self.maxsize = maxsize
+        self.store = store
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compile(self, source, filename, mode,
+                policy=UntrustedPythonNodeTransformer):
+        key = digest(source)
+        if key is None:
+            code, warns = _compile(source, filename, mode, policy)
+        else:
+            key = (key, filename, mode, policy)
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            if entry is None:
+                store = self.store
+                if store is not None:
+                    entry = store.load(key)
+                if entry is None:
+                    entry = _compile(source, filename, mode, policy)
+                    if store is not None:
+                        store.dump(key, entry)
+                self._store(key, entry)
+            code, warns = entry
+        for warning in warns:
+            warnings.warn(warning, SyntaxWarning)
+        return code
+
+    def compile_many(self, sources, filename, mode,
+                     policy=UntrustedPythonNodeTransformer, previous=(),
+                     executor=None, max_workers=None):
+        """Compile many sources, in parallel if needed.
+
+        Return a list of `BulkResult` in the order of `sources`.  Sources
+        which fail to compile do not raise, their result has no code but
+        the errors of the policy.  Identical sources are compiled once.
+
+        The results of `previous`, e.g. the results for the last version
+        of a bundle, are reused for unchanged sources compiled with the
+        same filename, mode and policy, as are the entries
+        of the cache.  The other sources are compiled in `executor` or in
+        a new process pool of `max_workers` processes.
+        """
+        if mode not in _compilers:
+            raise TypeError('unknown mode %s' % mode)
+        sources = list(sources)
+        digests = [digest(source) for source in sources]
+        if None in digests:
+            raise TypeError('compile_many() requires str or bytes sources')
+        known = {result.digest: result for result in previous
+                 if (result.filename, result.mode, result.policy)
+                 == (filename, mode, policy)}
+        pending = {}
+        for key, source in zip(digests, sources):
+            if key in known or key in pending:
+                continue
+            cache_key = (key, filename, mode, policy)
+            with self._lock:
+                entry = self._entries.get(cache_key)
+                if entry is not None:
+                    self._entries.move_to_end(cache_key)
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            if entry is None and self.store is not None:
+                entry = self.store.load(cache_key)
+                if entry is not None:
+                    self._store(cache_key, entry)
+            if entry is None:
+                pending[key] = source
+            else:
+                known[key] = BulkResult(key, entry[0], (), entry[1],
+                                        filename, mode, policy)
+        for key, result in self._compile_pending(
+                pending, filename, mode, policy, executor, max_workers):
+            if result.code is not None:
+                cache_key = (key, filename, mode, policy)
+                entry = result.code, result.warnings
+                if self.store is not None:
+                    self.store.dump(cache_key, entry)
+                self._store(cache_key, entry)
+            known[key] = result
+        return [known[key] for key in digests]
+
+    def _compile_pending(self, pending, filename, mode, policy, executor,
+                         max_workers):
+        if len(pending) < 2 and executor is None:
+            for key, source in pending.items():
+                result = _compilers[mode](source, filename, policy=policy)
+                yield key, BulkResult(key, result.code, tuple(result.errors),
+                                      tuple(result.warnings), filename, mode,
+                                      policy)
+            return
+        if executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers) as executor:
+                yield from self._compile_pending(
+                    pending, filename, mode, policy, executor, None)
+            return
+        n = len(pending)
+        results = executor.map(
+            _compile_marshalled, pending.values(), [filename] * n,
+            [mode] * n, [policy] * n)
+        for key, (code, errors, warns) in zip(pending, results):
+            if code is not None:
+                code = marshal.loads(code)
+            yield key, BulkResult(key, code, errors, warns, filename, mode,
+                                  policy)
+
+    def _store(self, key, entry):
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def resize(self, maxsize):
+        """Change the size limit, evicting entries if needed."""
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._entries) > maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, source, filename=None, mode=None):
+        """Drop the cached code for `source`.
+
+        If `filename` or `mode` are omitted, entries for every filename or
+        mode are dropped.  Return the number of dropped entries.
+        """
+        key = digest(source)
+        with self._lock:
+            stale = [k for k in self._entries
+                     if k[0] == key
+                     and (filename is None or k[1] == filename)
+                     and (mode is None or k[2] == mode)]
+            for k in stale:
+                del self._entries[k]
+        return len(stale)
+
+    def clear(self):
+        """Drop all entries and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             self.maxsize, len(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+cache = CompileCache()
+
+
 def compile(source, filename, mode):
-    return compile_restricted(source, filename, mode,
-                              policy=UntrustedPythonNodeTransformer)
+    return cache.compile(source, filename, mode)
+
+
+def compile_many(sources, filename, mode, **kw):
+    return cache.compile_many(sources, filename, mode, **kw)
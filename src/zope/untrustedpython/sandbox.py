@@ -0,0 +1,262 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Namespaces prepared by a prelude, shared by many executions."""
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from types import FunctionType
+from types import GeneratorType
+
+from zope.untrustedpython import rcompile
+from zope.untrustedpython.interpreter import CompiledProgram
+from zope.untrustedpython.interpreter import ExecutionContext
+from zope.untrustedpython.interpreter import _exec_printing
+from zope.untrustedpython.interpreter import _run
+
+
+_marker = object()
+
+
+def _rebind(function, globals):
+    """Return a copy of `function` using `globals`."""
+    clone = FunctionType(function.__code__, globals, function.__name__,
+                         function.__defaults__, function.__closure__)
+    clone.__kwdefaults__ = function.__kwdefaults__
+    clone.__qualname__ = function.__qualname__
+    clone.__dict__.update(function.__dict__)
+    return clone
+
+
+def _copy(value, memo):
+    """Return a copy of `value` if it is or holds a mutable container.
+
+    Lists, dicts, sets and bytearrays are copied, as are tuples holding
+    them; `memo` maps the ids of the values already copied to their
+    copies.  Other values are returned as they are.
+    """
+    copy = memo.get(id(value), _marker)
+    if copy is not _marker:
+        return copy
+    kind = type(value)
+    if kind is list:
+        copy = memo[id(value)] = []
+        copy.extend(_copy(item, memo) for item in value)
+    elif kind is dict:
+        copy = memo[id(value)] = {}
+        copy.update((key, _copy(item, memo)) for key, item in value.items())
+    elif kind in (set, bytearray):
+        copy = memo[id(value)] = kind(value)
+    elif kind is tuple:
+        copy = tuple(_copy(item, memo) for item in value)
+        if all(a is b for a, b in zip(copy, value)):
+            copy = value
+        memo[id(value)] = copy
+    else:
+        return value
+    return copy
+
+
+def _uses(value, globals):
+    """Tell whether `value` is a function, class or generator of `globals`.
+    """
+    if isinstance(value, type):
+        return any(_uses(item, globals) for item in vars(value).values())
+    if isinstance(value, GeneratorType):
+        return (value.gi_frame is not None
+                and value.gi_frame.f_globals is globals)
+    function = getattr(value, '__func__', value)
+    return (type(function) is FunctionType
+            and function.__globals__ is globals)
+
+
+class Sandbox:
+    """The namespace of a tenant, set up once by running `prelude`.
+
+    `prelude` is a source or a `CompiledProgram`, typically defining
+    helper functions.  It runs once in an `ExecutionContext` built from
+    `namespace` and `builtins`, and its resulting namespace is kept as a
+    snapshot.  Each execution gets a clone of the snapshot, updated with
+    its values, which is restored and recycled afterwards.  At most
+    `size` idle clones are kept.
+
+    The functions defined by the prelude are rebound to each clone, so
+    they see the globals of the execution calling them.  The lists, dicts,
+    sets and bytearrays created by the prelude are copied for each
+    execution, other values, like instances, are shared by all of them.
+
+    A clone is not recycled if the result of an execution is, or exports,
+    a function, a class or a generator using it, so these keep seeing the
+    globals of their execution.  Functions nested in other values, like
+    lists, see the next execution recycling the clone.
+    """
+
+    def __init__(self, prelude, namespace=None, builtins=None, size=8,
+                 output=None):
+        if not isinstance(prelude, CompiledProgram):
+            prelude = CompiledProgram(prelude, '<prelude>')
+        self.prelude = prelude
+        self.size = size
+        snapshot = ExecutionContext(namespace, builtins).exec_(
+            prelude, output=output)
+        snapshot.pop('_print', None)
+        self._snapshot = snapshot
+        self._protected = ExecutionContext(snapshot, builtins)._protected
+        # The names whose values are copied for each execution.
+        self._mutable = [name for name, value in snapshot.items()
+                         if _copy(value, {}) is not value]
+        self._pool = []
+        self._lock = threading.Lock()
+
+    def _clone(self):
+        """Return a new clone and the entries it is restored to."""
+        snapshot = self._snapshot
+        globals = {}
+        entries = {}
+        # The values of the clone replacing those of the snapshot.
+        functions = {id(snapshot): globals}
+        for value in snapshot.values():
+            if type(value) is FunctionType and value.__globals__ is snapshot:
+                functions[id(value)] = _rebind(value, globals)
+        for name, value in snapshot.items():
+            entries[name] = functions.get(id(value), value)
+        clone = globals, entries, functions
+        self._restore(clone)
+        return clone
+
+    def _restore(self, clone):
+        """Reset the globals of `clone` to fresh copies of the snapshot."""
+        globals, entries, functions = clone
+        if self._mutable:
+            memo = dict(functions)
+            for name in self._mutable:
+                entries[name] = _copy(self._snapshot[name], memo)
+        globals.clear()
+        globals.update(entries)
+
+    def _acquire(self, values):
+        with self._lock:
+            clone = self._pool.pop() if self._pool else None
+        if clone is None:
+            clone = self._clone()
+        globals = clone[0]
+        if values:
+            globals.update(values)
+            globals.update(self._protected)
+        return clone
+
+    def _release(self, clone, result=()):
+        """Restore and recycle `clone`, unless `result` uses it."""
+        globals = clone[0]
+        if any(_uses(value, globals) for value in result):
+            return
+        self._restore(clone)
+        with self._lock:
+            if len(self._pool) < self.size:
+                self._pool.append(clone)
+
+    @contextmanager
+    def namespace(self, values=None):
+        """Lend a clone of the snapshot holding `values`.
+
+        The clone is restored when the block ends, so it must not be used
+        afterwards.
+        """
+        clone = self._acquire(values)
+        try:
+            yield clone[0]
+        finally:
+            self._release(clone)
+
+    def eval(self, expression, values=None, budget=None):
+        """Evaluate a `CompiledExpression` or a code object in a clone.
+
+        See `ExecutionContext.eval`.
+        """
+        code = getattr(expression, 'code', expression)
+        clone = self._acquire(values)
+        result = ()
+        try:
+            result = _run(eval, code, clone[0], None, budget)
+            return result
+        finally:
+            self._release(clone, (result,))
+
+    def exec_(self, program, values=None, output=None, budget=None,
+              buffer_size=None):
+        """Execute a `CompiledProgram` or a code object in a clone.
+
+        Return a dict of the names which differ from the snapshot, i.e.
+        the `values` and the names bound by the program.  See
+        `CompiledProgram.exec_` for the other arguments.
+        """
+        code = getattr(program, 'code', program)
+        clone = self._acquire(values)
+        globals, entries = clone[:2]
+        result = {}
+        try:
+            _exec_printing(code, globals, None, output, budget, buffer_size)
+            result = {name: value for name, value in globals.items()
+                      if entries.get(name, _marker) is not value}
+            return result
+        finally:
+            self._release(clone, result.values())
+
+
+class SandboxPool:
+    """The sandboxes of many tenants.
+
+    At most `max_tenants` sandboxes are kept; the least recently used one
+    is dropped when a sandbox for another tenant is needed.  `size` is the
+    number of idle clones kept by each sandbox.
+    """
+
+    def __init__(self, max_tenants=64, size=8, builtins=None):
+        self.max_tenants = max_tenants
+        self.size = size
+        self.builtins = builtins
+        self._sandboxes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def sandbox(self, tenant, prelude, namespace=None):
+        """Return the sandbox of `tenant`.
+
+        The sandbox is created by running `prelude` if the tenant has no
+        sandbox yet or if its prelude changed.  Preludes without source,
+        like compiled programs whose source was dropped, are compared by
+        their code.
+        """
+        source = getattr(prelude, 'source', prelude)
+        key = rcompile.digest(source)
+        if key is None:
+            key = getattr(prelude, 'code', prelude)
+        with self._lock:
+            entry = self._sandboxes.get(tenant)
+            if entry is not None and entry[0] == key:
+                self._sandboxes.move_to_end(tenant)
+                return entry[1]
+        sandbox = Sandbox(prelude, namespace, self.builtins, self.size)
+        with self._lock:
+            self._sandboxes[tenant] = key, sandbox
+            self._sandboxes.move_to_end(tenant)
+            while len(self._sandboxes) > self.max_tenants:
+                self._sandboxes.popitem(last=False)
+        return sandbox
+
+    def discard(self, tenant):
+        """Drop the sandbox of `tenant`, if any."""
+        with self._lock:
+            self._sandboxes.pop(tenant, None)
+
+    def __len__(self):
+        return len(self._sandboxes)
@@ -0,0 +1,436 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Scheduling of executions by their estimated cost."""
+import ast
+import functools
+import math
+import os
+import threading
+import time
+from collections import Counter
+from collections import OrderedDict
+from collections import deque
+from concurrent.futures import Future
+
+from zope.untrustedpython import interpreter
+
+
+# Weight of the last running time in the average kept by the history.
+_smoothing = 0.25
+
+_comprehensions = (ast.ListComp, ast.SetComp, ast.DictComp,
+                   ast.GeneratorExp)
+
+# Calls iterating over their argument once.
+_passing = frozenset(['list', 'tuple', 'set', 'sorted', 'reversed',
+                      'enumerate'])
+
+
+class QueueFull(Exception):
+    """A tenant has too many executions waiting."""
+
+
+def _called(node):
+    """Return the name of the function called by `node`, if any."""
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+        return node.func.id
+    return None
+
+
+def _length(node):
+    """Return the length of the iterable `node` if known, else None."""
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        return len(node.elts)
+    if isinstance(node, ast.Dict):
+        return len(node.keys)
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return len(node.value)
+    name = _called(node)
+    if name == 'range' and not node.keywords:
+        values = [arg.value for arg in node.args
+                  if isinstance(arg, ast.Constant)]
+        if values and len(values) == len(node.args) and all(
+                type(value) is int for value in values):
+            try:
+                return len(range(*values))
+            except (TypeError, ValueError, OverflowError):
+                pass
+    elif name in _passing and len(node.args) == 1:
+        return _length(node.args[0])
+    return None
+
+
+def _iterations(node, iterations):
+    """Return the estimated length of the iterable `node`."""
+    n = _length(node)
+    return iterations if n is None else n
+
+
+def _while_bound(node):
+    """Return the number of iterations of the ``while`` loop `node`.
+
+    Only loops comparing a name assigned in their body to an integer
+    literal, like ``while n < 10``, are known to end; they are assumed to
+    count from 0.  Return None for the others.
+    """
+    test = node.test
+    if not (isinstance(test, ast.Compare) and len(test.ops) == 1
+            and isinstance(test.ops[0], (ast.Lt, ast.LtE, ast.NotEq))
+            and isinstance(test.left, ast.Name)
+            and isinstance(test.comparators[0], ast.Constant)
+            and type(test.comparators[0].value) is int):
+        return None
+    name = test.left.id
+    for child in node.body:
+        for target in ast.walk(child):
+            if (isinstance(target, ast.Name) and target.id == name
+                    and isinstance(target.ctx, ast.Store)):
+                return max(test.comparators[0].value, 0)
+    return None
+
+
+def _cost(node, iterations):
+    """Return the estimated number of operations executing `node`."""
+    if isinstance(node, ast.For):
+        n = _iterations(node.iter, iterations)
+        return (_cost(node.iter, iterations)
+                + n * (1 + _costs(node.body, iterations))
+                + _costs(node.orelse, iterations))
+    if isinstance(node, ast.While):
+        n = _while_bound(node)
+        if n is None:
+            n = iterations
+        return (n * (_cost(node.test, iterations)
+                     + _costs(node.body, iterations))
+                + _costs(node.orelse, iterations))
+    if isinstance(node, _comprehensions):
+        if isinstance(node, ast.DictComp):
+            elements = [node.key, node.value]
+        else:
+            elements = [node.elt]
+        cost = 0
+        n = 1
+        for generator in node.generators:
+            cost += n * _cost(generator.iter, iterations)
+            n *= _iterations(generator.iter, iterations)
+            elements.extend(generator.ifs)
+        return cost + n * (1 + _costs(elements, iterations))
+    cost = 1 if isinstance(node, (ast.stmt, ast.expr)) else 0
+    if _called(node) == 'sorted' and node.args:
+        n = _iterations(node.args[0], iterations)
+        cost += n * max(1, math.log2(max(n, 1)))
+    return cost + _costs(ast.iter_child_nodes(node), iterations)
+
+
+def _costs(nodes, iterations):
+    return sum(_cost(node, iterations) for node in nodes)
+
+
+@functools.lru_cache(maxsize=1024)
+def static_cost(source, iterations=100):
+    """Return the estimated number of operations executing `source`.
+
+    Each statement and expression counts as one operation.  The body of a
+    loop or comprehension counts once per iteration, so nested loops
+    multiply their costs, and ``sorted`` counts ``n log n`` operations.
+    Loops over ``range`` with literal arguments or over literals iterate
+    over their length, ``while`` loops comparing a counter to an integer
+    literal, like ``while n < 10``, as many times as the literal, other
+    ``for`` loops `iterations` times.  The bodies of functions count as if
+    they were called once.
+
+    Return `math.inf` if `source` has another ``while`` loop, which may
+    never end, and None if `source` cannot be parsed.
+    """
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError, TypeError):
+        return None
+    for node in ast.walk(tree):
+        if isinstance(node, ast.While) and _while_bound(node) is None:
+            return math.inf
+    return _cost(tree, iterations)
+
+
+@functools.lru_cache(maxsize=1024)
+def bounded(source):
+    """Tell whether `static_cost` bounds the operations of `source`.
+
+    It is not if it defines functions, which may recurse, if it has loops,
+    comprehensions or calls like ``sorted`` iterating over iterables of
+    unknown length, or calls ``range`` with other arguments than integer
+    literals, or if it has ``while`` loops of unknown bound, see
+    `static_cost`.  Sources which cannot be parsed are not either.
+    """
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError, TypeError):
+        return False
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+                             ast.Lambda)):
+            return False
+        if isinstance(node, ast.While) and _while_bound(node) is None:
+            return False
+        if (isinstance(node, (ast.For, ast.AsyncFor, ast.comprehension))
+                and _length(node.iter) is None):
+            return False
+        name = _called(node)
+        if name == 'range' and _length(node) is None:
+            return False
+        if name in _passing and any(_length(arg) is None
+                                    for arg in node.args):
+            return False
+    return True
+
+
+class _Lane:
+    """The executions waiting for a pool, queued by tenant."""
+
+    def __init__(self, slots, submit):
+        self.slots = slots
+        self.submit = submit
+        self.running = 0
+        self.queues = OrderedDict()
+
+    def pop(self):
+        """Return the next execution, the tenants taking turns."""
+        tenant, queue = next(iter(self.queues.items()))
+        job = queue.popleft()
+        if queue:
+            self.queues.move_to_end(tenant)
+        else:
+            del self.queues[tenant]
+        return job
+
+
+class Scheduler:
+    """Run compiled programs inline, in a thread or in a process.
+
+    The running time of a program is estimated from its previous
+    executions if there were any, else as its `static_cost` times
+    `operation_time` seconds; `iterations` is passed to `static_cost`.
+    Programs estimated to end within `inline_limit` seconds run in the
+    calling thread, as handing them off would cost more than running them,
+    unless they are not known to end, see `bounded`: programs with loops
+    of unknown bound or defining functions, and programs without source,
+    always run in a pool.
+    Programs estimated to run longer than `process_limit` seconds run in a
+    `zope.untrustedpython.interpreter.ProcessPoolRunner` of
+    `max_processes` workers, so they neither block the caller nor hold its
+    GIL; their globals must be picklable.  The others run in a pool of
+    `max_threads` threads, as do all of them if `max_processes` is 0.
+    Programs whose source was dropped run in a thread until they have a
+    history.  The pools are started on first use.
+
+    The executions waiting for a pool are queued by tenant and the tenants
+    take turns, so a tenant submitting many executions does not starve the
+    others.  `QueueFull` is raised when a tenant already has `max_queued`
+    executions waiting for a pool.
+
+    The history holds a moving average of the running times of the last
+    `history_size` programs, keyed by their code.  `routed` counts the
+    executions by route.
+    """
+
+    def __init__(self, max_threads=4, max_processes=None, max_queued=100,
+                 inline_limit=1e-4, process_limit=0.05, operation_time=5e-8,
+                 iterations=100, history_size=1024, mp_context=None):
+        self.max_queued = max_queued
+        self.inline_limit = inline_limit
+        self.process_limit = process_limit
+        self.operation_time = operation_time
+        self.iterations = iterations
+        self.history_size = history_size
+        self.mp_context = mp_context
+        self.routed = Counter()
+        # Import the safe builtins now rather than in the first execution,
+        # whose running time would be recorded.
+        interpreter._security.SafeBuiltins
+        self._history = OrderedDict()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._threads = None
+        self._processes = None
+        if max_processes is None:
+            max_processes = os.cpu_count() or 1
+        self._lanes = {'thread': _Lane(max_threads, self._submit_thread)}
+        if max_processes:
+            self._lanes['process'] = _Lane(max_processes,
+                                           self._submit_process)
+
+    def estimate(self, program):
+        """Return the estimated running time of `program` in seconds.
+
+        Return None if it has neither a history nor a source.
+        """
+        seconds = self._history.get(program.code)
+        if seconds is not None:
+            return seconds
+        source = program.source
+        if source is None:
+            return None
+        cost = static_cost(source, self.iterations)
+        return None if cost is None else cost * self.operation_time
+
+    def route(self, program):
+        """Return where `program` runs: inline, thread or process."""
+        seconds = self.estimate(program)
+        if seconds is None:
+            return 'thread'
+        if seconds < self.inline_limit and self._ends(program):
+            return 'inline'
+        if seconds < self.process_limit or 'process' not in self._lanes:
+            return 'thread'
+        return 'process'
+
+    def _ends(self, program):
+        """Tell whether `program` is known to end, whatever its history."""
+        source = program.source
+        return source is not None and bounded(source)
+
+    def submit(self, program, globals=None, names=None, tenant=None,
+               budget=None):
+        """Execute `program` with `budget` if given.
+
+        Return a future whose result is an `ExecutionResult`, as returned
+        by `ProcessPoolRunner.submit` whichever the route.  The future of
+        an inline execution is done when this method returns.
+
+        `budget` is pickled for executions in a process, so the counters
+        of the caller's budget, like `elapsed` or `operations_used`, are
+        only updated by executions inline or in a thread, and cancelling
+        it does not stop an execution in a process.
+        """
+        if self._closed:
+            raise RuntimeError('The scheduler was shut down.')
+        route = self.route(program)
+        future = Future()
+        if route == 'inline':
+            future.set_running_or_notify_cancel()
+            start = time.perf_counter()
+            try:
+                result = interpreter._execute(
+                    program.code, dict(globals or {}), names, budget)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            self._record(program.code, time.perf_counter() - start)
+            with self._lock:
+                self.routed[route] += 1
+            return future
+        lane = self._lanes[route]
+        with self._lock:
+            if len(lane.queues.get(tenant, ())) >= self.max_queued:
+                raise QueueFull(
+                    f'{tenant!r} has {self.max_queued} executions waiting.')
+            lane.queues.setdefault(tenant, deque()).append(
+                (future, program, globals, names, budget))
+            self.routed[route] += 1
+        self._dispatch(lane)
+        return future
+
+    def queued(self, tenant=None):
+        """Return the number of executions of `tenant` waiting."""
+        with self._lock:
+            return sum(len(lane.queues.get(tenant, ()))
+                       for lane in self._lanes.values())
+
+    def _record(self, code, seconds):
+        with self._lock:
+            history = self._history
+            average = history.get(code)
+            if average is not None:
+                seconds = average + (seconds - average) * _smoothing
+                history.move_to_end(code)
+            history[code] = seconds
+            while len(history) > self.history_size:
+                history.popitem(last=False)
+
+    def _submit_thread(self, program, globals, names, budget):
+        with self._lock:
+            if self._threads is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._threads = ThreadPoolExecutor(
+                    self._lanes['thread'].slots)
+        return self._threads.submit(interpreter._execute, program.code,
+                                    dict(globals or {}), names, budget)
+
+    def _submit_process(self, program, globals, names, budget):
+        with self._lock:
+            if self._processes is None:
+                self._processes = interpreter.ProcessPoolRunner(
+                    self._lanes['process'].slots,
+                    mp_context=self.mp_context)
+        return self._processes.submit(program, globals, names, budget)
+
+    def _dispatch(self, lane):
+        """Start waiting executions while `lane` has free slots."""
+        while True:
+            with self._lock:
+                if lane.running >= lane.slots or not lane.queues:
+                    return
+                job = lane.pop()
+                if not job[0].set_running_or_notify_cancel():
+                    continue
+                lane.running += 1
+            self._start(lane, job)
+
+    def _start(self, lane, job):
+        future, program, globals, names, budget = job
+        start = time.perf_counter()
+
+        def done(inner):
+            if not inner.cancelled():
+                self._record(program.code, time.perf_counter() - start)
+            with self._lock:
+                lane.running -= 1
+            error = (inner.exception() if not inner.cancelled()
+                     else RuntimeError('The execution was cancelled.'))
+            if error is None:
+                future.set_result(inner.result())
+            else:
+                future.set_exception(error)
+            self._dispatch(lane)
+
+        try:
+            inner = lane.submit(program, globals, names, budget)
+        except Exception as e:
+            with self._lock:
+                lane.running -= 1
+            future.set_exception(e)
+            return
+        inner.add_done_callback(done)
+
+    def shutdown(self, wait=True):
+        """Cancel the waiting executions and stop the pools."""
+        with self._lock:
+            self._closed = True
+            jobs = [job for lane in self._lanes.values()
+                    for queue in lane.queues.values() for job in queue]
+            for lane in self._lanes.values():
+                lane.queues.clear()
+        for job in jobs:
+            job[0].cancel()
+        if self._threads is not None:
+            self._threads.shutdown(wait)
+        if self._processes is not None:
+            self._processes.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
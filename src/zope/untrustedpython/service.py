@@ -0,0 +1,542 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""A daemon executing untrusted code in worker processes, and its client.
+
+The client and the server talk over a Unix socket.  Each frame is made of
+a header, holding the length of the payload, the kind of the frame and
+the id of the request, followed by the payload.  A request holds the
+content hash of the marshalled code, the code itself if it was not sent
+over the connection yet, and the pickled arguments of the execution.  A
+response holds the pickled `ExecutionResult` or exception, or asks for the
+code again if the server dropped it.  The server does not unpickle the
+results, it passes the bytes produced by the worker on to the client.
+
+Run ``python -m zope.untrustedpython.service PATH`` to start a daemon.
+"""
+import argparse
+import hashlib
+import itertools
+import marshal
+import os
+import pickle
+import queue
+import signal
+import socket
+import stat
+import struct
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from zope.untrustedpython import interpreter
+from zope.untrustedpython.budget import Budget
+
+
+# The length of the payload, the kind of the frame and the request id.
+_header = struct.Struct('!IBI')
+# The kind of a response and the memory used by the worker.
+_reply = struct.Struct('!BQ')
+# Prefixes the marshalled code in a request.
+_code_length = struct.Struct('!I')
+
+_REQUEST = 1
+_RESULT = 2
+_ERROR = 3
+# The server dropped the code of the request, which must be sent again.
+_UNKNOWN = 4
+
+_key_size = hashlib.sha256().digest_size
+
+
+class WorkerError(Exception):
+    """A worker crashed or was killed."""
+
+
+def _read_frame(reader):
+    """Return the kind, the request id and the payload of the next frame.
+
+    Return None if the connection was closed.
+    """
+    header = reader.read(_header.size)
+    if len(header) < _header.size:
+        return None
+    length, kind, request_id = _header.unpack(header)
+    payload = reader.read(length)
+    if len(payload) < length:
+        return None
+    return kind, request_id, payload
+
+
+def _frame(kind, request_id, payload):
+    return _header.pack(len(payload), kind, request_id) + payload
+
+
+def _split(request):
+    """Split a request into the code key, the code and the arguments."""
+    key = request[:_key_size]
+    (length,) = _code_length.unpack_from(request, _key_size)
+    start = _key_size + _code_length.size
+    return key, request[start:start + length], request[start + length:]
+
+
+def _join(key, data, args):
+    return b''.join((key, _code_length.pack(len(data)), data, args))
+
+
+def _dump_error(error):
+    try:
+        payload = pickle.dumps(error, pickle.HIGHEST_PROTOCOL)
+        pickle.loads(payload)
+    except Exception:
+        payload = pickle.dumps(WorkerError(repr(error)))
+    return payload
+
+
+def _rss():
+    """Return the peak resident memory of the process in bytes."""
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _work(connection):
+    """Execute the requests sent over `connection` until it is closed."""
+    # Import the safe builtins before the first request comes in.
+    interpreter._security.SafeBuiltins
+    while True:
+        try:
+            request = connection.recv_bytes()
+        except EOFError:
+            return
+        if not request:
+            return
+        key, data, args = _split(request)
+        try:
+            globals, names, limits = pickle.loads(args)
+            budget = Budget(**limits) if limits else None
+            result = interpreter._exec_in_worker(
+                key, data or None, globals, names, budget)
+            kind = _RESULT
+            payload = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            kind = _ERROR
+            payload = _dump_error(e)
+        connection.send_bytes(_reply.pack(kind, _rss()) + payload)
+
+
+class _Worker:
+    """A worker process and the code it knows."""
+
+    def __init__(self, context):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=_work, args=(child,),
+                                       daemon=True)
+        self.process.start()
+        child.close()
+        self.known = set()
+        self.executions = 0
+        self.rss = 0
+
+    def execute(self, key, data, args, timeout):
+        """Return the kind and the payload of the response."""
+        try:
+            self.connection.send_bytes(_join(key, data, args))
+            if not self.connection.poll(timeout):
+                self.stop()
+                raise WorkerError(
+                    f'The execution did not end within {timeout} seconds.')
+            response = self.connection.recv_bytes()
+        except (EOFError, OSError):
+            self.stop()
+            raise WorkerError(
+                f'The worker died with exit code {self.process.exitcode}.')
+        self.known.add(key)
+        self.executions += 1
+        kind, self.rss = _reply.unpack_from(response)
+        return kind, response[_reply.size:]
+
+    def stop(self):
+        try:
+            self.connection.send_bytes(b'')
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.connection.close()
+
+
+class _Channel:
+    """A connection of a client to the server."""
+
+    def __init__(self, sock):
+        self.socket = sock
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.reading = True
+
+    def reply(self, request_id, kind, payload):
+        with self.lock:
+            try:
+                self.socket.sendall(_frame(kind, request_id, payload))
+            except OSError:
+                pass
+            self.pending -= 1
+            self._close_if_done()
+
+    def _close_if_done(self):
+        if not self.reading and not self.pending:
+            self.socket.close()
+
+
+class Server:
+    """Execute the requests of clients in a pool of worker processes.
+
+    The server listens on the Unix socket `path`, which is created with
+    permissions for the owner only; as clients send code objects to
+    execute, only trusted users may connect.  A socket left at `path` is
+    replaced, but `FileExistsError` is raised for other files.  Requests
+    are executed by `workers` processes, as many as CPUs by default, which
+    import the safe builtins when they start and keep the code objects
+    they executed.
+    A worker is replaced by a new one after `max_executions` executions,
+    once its peak resident memory exceeds `max_rss` bytes, when it crashes
+    and when an execution lasts longer than `timeout` seconds; a
+    `WorkerError` is raised to the client in the last two cases.  The
+    server keeps the last `max_codes` code objects it received; clients
+    send the others again when they are needed.
+
+    The workers are started with `mp_context`, ``spawn`` by default.
+    """
+
+    def __init__(self, path, workers=None, max_executions=1000,
+                 max_rss=None, timeout=None, mp_context=None,
+                 poll_interval=0.5, max_codes=1024):
+        import multiprocessing
+        self.path = path
+        self.workers = workers or os.cpu_count() or 1
+        self.max_executions = max_executions
+        self.max_rss = max_rss
+        self.timeout = timeout
+        self.max_codes = max_codes
+        self.recycled = 0
+        self._context = mp_context or multiprocessing.get_context('spawn')
+        self._codes = OrderedDict()
+        self._codes_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._channels = set()
+        self._stopped = threading.Event()
+        try:
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise FileExistsError(f'{path} exists and is not a socket.')
+            os.unlink(path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # The socket must never be accessible by other users.
+        umask = os.umask(0o177)
+        try:
+            self._socket.bind(path)
+        finally:
+            os.umask(umask)
+        self._socket.listen()
+        self._socket.settimeout(poll_interval)
+
+    def serve_forever(self):
+        """Serve the clients until `shutdown` is called."""
+        slots = [threading.Thread(target=self._serve_slot, daemon=True)
+                 for i in range(self.workers)]
+        for slot in slots:
+            slot.start()
+        try:
+            while not self._stopped.is_set():
+                try:
+                    sock, address = self._socket.accept()
+                except socket.timeout:
+                    continue
+                sock.settimeout(None)
+                channel = _Channel(sock)
+                self._channels.add(channel)
+                threading.Thread(target=self._serve_channel,
+                                 args=(channel,), daemon=True).start()
+        finally:
+            self._socket.close()
+            os.unlink(self.path)
+            for slot in slots:
+                self._queue.put(None)
+            for slot in slots:
+                slot.join()
+            # Requests received from now on are never answered.
+            for channel in list(self._channels):
+                try:
+                    channel.socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def shutdown(self):
+        """Make `serve_forever` return.
+
+        Requests which were already received are still executed.
+        """
+        self._stopped.set()
+
+    def _serve_channel(self, channel):
+        reader = channel.socket.makefile('rb')
+        try:
+            while True:
+                frame = _read_frame(reader)
+                if frame is None or frame[0] != _REQUEST:
+                    break
+                kind, request_id, payload = frame
+                key, data, args = _split(payload)
+                if data:
+                    with self._codes_lock:
+                        self._codes[key] = data
+                        self._codes.move_to_end(key)
+                        while len(self._codes) > self.max_codes:
+                            self._codes.popitem(last=False)
+                with channel.lock:
+                    channel.pending += 1
+                self._queue.put((channel, request_id, key, args))
+        except OSError:
+            pass
+        finally:
+            reader.close()
+            self._channels.discard(channel)
+            with channel.lock:
+                channel.reading = False
+                channel._close_if_done()
+
+    def _serve_slot(self):
+        worker = _Worker(self._context)
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            channel, request_id, key, args = job
+            data = b'' if key in worker.known else self._code(key)
+            if data is None:
+                kind = _UNKNOWN
+                payload = b''
+            else:
+                try:
+                    kind, payload = worker.execute(key, data, args,
+                                                   self.timeout)
+                except WorkerError as e:
+                    kind = _ERROR
+                    payload = _dump_error(e)
+                    worker = _Worker(self._context)
+            channel.reply(request_id, kind, payload)
+            if (worker.executions >= self.max_executions
+                    or self.max_rss is not None
+                    and worker.rss > self.max_rss):
+                worker.stop()
+                self.recycled += 1
+                worker = _Worker(self._context)
+        worker.stop()
+
+    def _code(self, key):
+        with self._codes_lock:
+            data = self._codes.get(key)
+            if data is not None:
+                self._codes.move_to_end(key)
+            return data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+class _Connection:
+    """A connection to the server, sending requests without waiting."""
+
+    def __init__(self, path):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.socket.connect(path)
+        except OSError as e:
+            self.socket.close()
+            raise ConnectionError(f'Cannot connect to {path}.') from e
+        self.pending = {}
+        self.shipped = set()
+        self.broken = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def submit(self, key, data, args):
+        future = Future()
+        with self._lock:
+            request_id = self._send(future, key, data, args)
+        if self.broken is not None and self.pending.pop(request_id, None):
+            raise ConnectionError(
+                'The connection to the server broke.') from self.broken
+        return future
+
+    def _send(self, future, key, data, args, resend=False):
+        """Send a request, with the code if the server may not have it."""
+        request_id = next(self._ids) & 0xffffffff
+        self.pending[request_id] = future, key, data, args
+        if self.broken is None:
+            shipped = key in self.shipped and not resend
+            try:
+                self.socket.sendall(_frame(
+                    _REQUEST, request_id,
+                    _join(key, b'' if shipped else data, args)))
+            except OSError as e:
+                self._fail(e)
+            self.shipped.add(key)
+        return request_id
+
+    def _read(self):
+        reader = self.socket.makefile('rb')
+        try:
+            while True:
+                frame = _read_frame(reader)
+                if frame is None:
+                    raise ConnectionError('The server closed the connection.')
+                kind, request_id, payload = frame
+                entry = self.pending.pop(request_id, None)
+                if entry is None:
+                    continue
+                future, key, data, args = entry
+                if kind == _UNKNOWN:
+                    with self._lock:
+                        self._send(future, key, data, args, resend=True)
+                    continue
+                value = pickle.loads(payload)
+                if kind == _RESULT:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            reader.close()
+
+    def _fail(self, error):
+        self.broken = error
+        while self.pending:
+            try:
+                request_id, entry = self.pending.popitem()
+            except KeyError:
+                break
+            failure = ConnectionError('The connection to the server broke.')
+            failure.__cause__ = error
+            entry[0].set_exception(failure)
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+
+class Client:
+    """A client of a `Server` listening on the Unix socket `path`.
+
+    Up to `connections` connections are opened as requests are submitted;
+    a request is sent over the connection with the fewest pending
+    requests, without waiting for the responses of the previous ones.
+    A code object is only sent once per connection, later requests only
+    send its content hash.  Broken connections are replaced.
+    """
+
+    def __init__(self, path, connections=4):
+        self.path = path
+        self.connections = connections
+        self._connections = []
+        self._marshalled = {}
+        self._lock = threading.Lock()
+
+    def _marshal(self, code):
+        try:
+            return self._marshalled[code]
+        except KeyError:
+            data = marshal.dumps(code)
+            entry = hashlib.sha256(data).digest(), data
+            self._marshalled[code] = entry
+            return entry
+
+    def _connection(self):
+        with self._lock:
+            connections = [c for c in self._connections if c.broken is None]
+            connection = min(connections, default=None,
+                             key=lambda c: len(c.pending))
+            if connection is None or (connection.pending and
+                                      len(connections) < self.connections):
+                connection = _Connection(self.path)
+                connections.append(connection)
+            self._connections = connections
+            return connection
+
+    def submit(self, program, globals=None, names=None, limits=None):
+        """Execute a `CompiledProgram` or a code object in the server.
+
+        Return a future of an `ExecutionResult`, see
+        `ProcessPoolRunner.submit` for `globals` and `names`.  `limits`
+        are keyword arguments of the `Budget` of the execution, e.g.
+        ``{'seconds': 1}``; the ``output`` limit is not supported.
+        """
+        key, data = self._marshal(getattr(program, 'code', program))
+        args = pickle.dumps((dict(globals or {}), names, limits),
+                            pickle.HIGHEST_PROTOCOL)
+        return self._connection().submit(key, data, args)
+
+    def exec_(self, program, globals=None, names=None, limits=None):
+        """Execute the program and return its `ExecutionResult`."""
+        return self.submit(program, globals, names, limits).result()
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Execute untrusted code for the clients of a socket.')
+    parser.add_argument('path', help='the path of the Unix socket')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-executions', type=int, default=1000)
+    parser.add_argument('--max-rss', type=int, default=None,
+                        help='the peak memory of a worker, in MiB')
+    parser.add_argument('--timeout', type=float, default=None)
+    options = parser.parse_args(argv)
+    server = Server(options.path, options.workers, options.max_executions,
+                    options.max_rss and options.max_rss * 2 ** 20,
+                    options.timeout)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
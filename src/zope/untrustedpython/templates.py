@@ -0,0 +1,204 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Expressions compiled once per shape.
+
+Expressions which only differ in their literals, like ``price * 1.07``
+and ``price * 1.08``, have the same shape.  The literals are replaced by
+placeholders, the resulting shape is compiled (and cached by
+`zope.untrustedpython.rcompile`) and the placeholders in the constants of
+the code object are replaced by the literals again.
+"""
+import ast
+import operator
+
+from zope.untrustedpython import rcompile
+from zope.untrustedpython.interpreter import CompiledExpression
+from zope.untrustedpython.interpreter import _guard_names
+from zope.untrustedpython.interpreter import _intern
+
+
+_PLACEHOLDER = '\0zope.untrustedpython.templates.slot:%d'
+
+_numbers = (int, float, complex)
+_hoisted = (int, float, complex, str, bytes)
+
+_binary_operators = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+
+_unary_operators = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+    ast.Not: operator.not_,
+}
+
+# Scopes in which names are not looked up in the namespace of the
+# expression; their constants are left alone.
+_nested_scopes = (ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp,
+                  ast.GeneratorExp)
+
+
+def _is_number(node):
+    return (isinstance(node, ast.Constant)
+            and isinstance(node.value, _numbers)
+            and not isinstance(node.value, bool))
+
+
+class ConstantFolder(ast.NodeTransformer):
+    """Fold arithmetic on numeric literals.
+
+    Only operations which cannot raise and cannot produce huge results
+    are folded, everything else is left to run time.
+    """
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        op = _binary_operators.get(type(node.op))
+        if op is None or not (_is_number(node.left)
+                              and _is_number(node.right)):
+            return node
+        left, right = node.left.value, node.right.value
+        if op is operator.pow and not (
+                isinstance(right, int) and 0 <= right <= 64
+                and abs(left) < 2 ** 64):
+            return node
+        try:
+            value = op(left, right)
+        except ArithmeticError:
+            return node
+        return ast.copy_location(ast.Constant(value), node)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        op = _unary_operators.get(type(node.op))
+        if op is None or not _is_number(node.operand):
+            return node
+        return ast.copy_location(ast.Constant(op(node.operand.value)), node)
+
+
+class LiteralHoister(ast.NodeTransformer):
+    """Replace literals by placeholders, collecting their values."""
+
+    def __init__(self):
+        self.values = []
+
+    def visit_Constant(self, node):
+        if (not isinstance(node.value, _hoisted)
+                or isinstance(node.value, bool)):
+            return node
+        placeholder = _PLACEHOLDER % len(self.values)
+        self.values.append(node.value)
+        return ast.copy_location(ast.Constant(placeholder), node)
+
+    def _keep(self, node):
+        return node
+
+    # The compiler may optimize constants in these places away.
+    visit_JoinedStr = _keep
+
+    def visit_BinOp(self, node):
+        if (isinstance(node.left, ast.Constant)
+                and isinstance(node.right, ast.Constant)):
+            return node
+        return self.generic_visit(node)
+
+    def visit_IfExp(self, node):
+        node.body = self.visit(node.body)
+        node.orelse = self.visit(node.orelse)
+        return node
+
+    def visit_BoolOp(self, node):
+        node.values = [value if isinstance(value, ast.Constant)
+                       else self.visit(value) for value in node.values]
+        return node
+
+    def generic_visit(self, node):
+        if isinstance(node, _nested_scopes):
+            return node
+        return ast.NodeTransformer.generic_visit(self, node)
+
+
+def parameterize(source):
+    """Return the shape of the expression `source` and its literals."""
+    tree = ast.parse(source, mode='eval')
+    tree = ConstantFolder().visit(tree)
+    hoister = LiteralHoister()
+    tree = hoister.visit(tree)
+    return ast.unparse(tree), hoister.values
+
+
+def _substitute(value, slots, found):
+    if type(value) is str:
+        if value in slots:
+            found.add(value)
+            return slots[value]
+    elif type(value) is tuple:
+        return tuple(_substitute(v, slots, found) for v in value)
+    elif type(value) is frozenset:
+        return frozenset(_substitute(v, slots, found) for v in value)
+    elif type(value) is slice:
+        return slice(_substitute(value.start, slots, found),
+                     _substitute(value.stop, slots, found),
+                     _substitute(value.step, slots, found))
+    return value
+
+
+def bind(code, values):
+    """Return `code` with the placeholders replaced by `values`.
+
+    Return None if the compiler did not keep all placeholders intact.
+    """
+    slots = {_PLACEHOLDER % i: value for i, value in enumerate(values)}
+    found = set()
+    consts = tuple(_substitute(c, slots, found) for c in code.co_consts)
+    if len(found) != len(slots):
+        return None
+    return code.replace(co_consts=consts)
+
+
+class TemplateExpression(CompiledExpression):
+    """A compiled expression sharing its code with expressions of the
+    same shape.
+
+    It behaves exactly like a `CompiledExpression`; `shape` is the
+    normalized source the code was compiled from, or None if the
+    expression could not be parameterized.
+    """
+
+    __slots__ = ('shape',)
+
+    _state = CompiledExpression._state + __slots__
+
+    def __init__(self, source, filename='<string>'):
+        try:
+            shape, values = parameterize(source)
+        except (SyntaxError, ValueError, TypeError):
+            shape = code = None
+        else:
+            code = bind(rcompile.compile(shape, filename, 'eval'), values)
+        if code is None:
+            CompiledExpression.__init__(self, source, filename)
+            self.shape = None
+        else:
+            self.source = source
+            self.code = _intern(code)
+            self.pure = False
+            self._guards = _guard_names(code)
+            self.shape = shape
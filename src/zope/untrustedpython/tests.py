@@ -11,13 +11,44 @@
 # FOR A PARTICULAR PURPOSE.
 #
 ##############################################################################
+import ast
+import asyncio
+import functools
+import math
+import os
 import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import tracemalloc
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
+from unittest import mock
 
+from zope.untrustedpython import builtins
+from zope.untrustedpython import diagnostics
+from zope.untrustedpython import diskcache
+from zope.untrustedpython import guards
 from zope.untrustedpython import interpreter
+from zope.untrustedpython import printing
+from zope.untrustedpython import profiling
 from zope.untrustedpython import rcompile
+from zope.untrustedpython import sandbox
+from zope.untrustedpython import scheduler
+from zope.untrustedpython import service
+from zope.untrustedpython import templates
+from zope.untrustedpython import vectorized
+from zope.untrustedpython.budget import Budget
+from zope.untrustedpython.budget import BudgetExceeded
+from zope.untrustedpython.budget import MemoryLimitExceeded
+from zope.untrustedpython.budget import OutputLimitExceeded
+from zope.untrustedpython.builtins import FastSafeBuiltins
 from zope.untrustedpython.builtins import SafeBuiltins
+from zope.untrustedpython.guards import guarded_getattr
+from zope.untrustedpython.transformer import UntrustedPythonNodeTransformer
 
 
 IS_PYPY = platform.python_implementation() == 'PyPy'
@@ -69,6 +100,86 @@ class Test_SafeBuiltins(unittest.TestCase):
             zope.security)
 
 
+class Test_LazyImports(unittest.TestCase):
+
+    def test_security_imported_on_first_use(self):
+        script = (
+            'import sys\n'
+            'from zope.untrustedpython import interpreter\n'
+            'print(sorted(m for m in ("zope.security", "asyncio")'
+            ' if m in sys.modules))\n'
+            'e = interpreter.CompiledExpression("len(x)")\n'
+            'print(e.eval({"x": "a"}))\n'
+            'print("zope.security" in sys.modules)\n')
+        output = subprocess.check_output([sys.executable, '-c', script])
+        self.assertEqual(output.decode().split(), ['[]', '1', 'True'])
+
+    def test_builtins_module_getattr(self):
+        self.assertIs(builtins.SafeBuiltins, SafeBuiltins)
+        self.assertIs(interpreter.SafeBuiltins, SafeBuiltins)
+        self.assertIs(interpreter.guarded_getattr, guarded_getattr)
+        with self.assertRaises(AttributeError):
+            builtins.UnsafeBuiltins
+        with self.assertRaises(AttributeError):
+            interpreter.unknown
+
+
+class Test_FastSafeBuiltins(unittest.TestCase):
+
+    def test_value_safe_unproxied(self):
+        from zope.security.proxy import Proxy
+        self.assertIs(FastSafeBuiltins.len, len)
+        self.assertIs(FastSafeBuiltins.max, max)
+        self.assertIsInstance(SafeBuiltins.len, Proxy)
+        self.assertIsInstance(FastSafeBuiltins.getattr, Proxy)
+        self.assertIsInstance(FastSafeBuiltins.__import__, Proxy)
+
+    @unittest.skipIf(IS_PYPY, 'PyPy does not support proxies.')
+    def test_others_proxied(self):
+        from zope.security.proxy import Proxy
+        for name, value in FastSafeBuiltins.__dict__.items():
+            if name.startswith('__') or name in ('True', 'False', 'None'):
+                continue
+            if name not in builtins.value_safe_names:
+                self.assertIsInstance(value, Proxy, name)
+
+    def test_context(self):
+        context = interpreter.ExecutionContext(builtins=FastSafeBuiltins)
+        p = interpreter.CompiledExpression('len(x) + abs(y)')
+        self.assertEqual(context.eval(p, {'x': 'abc', 'y': -1}), 4)
+        globals = context.namespace()
+        self.assertIs(globals['__builtins__'], FastSafeBuiltins)
+        self.assertIs(globals['_getattr_'], guarded_getattr)
+
+
+class Test_Guards(unittest.TestCase):
+
+    def test_getattr_proxies_result(self):
+        from zope.security.proxy import Proxy
+        result = guarded_getattr({}, 'update')
+        self.assertIsInstance(result, Proxy)
+        self.assertEqual(guarded_getattr(3 + 2j, 'real'), 3.0)
+
+    def test_getattr_proxied(self):
+        from zope.security.checker import NamesChecker
+        from zope.security.interfaces import ForbiddenAttribute
+        from zope.security.proxy import ProxyFactory
+
+        class C:
+            a = 1
+            b = 2
+
+        c = ProxyFactory(C(), NamesChecker(['a']))
+        self.assertEqual(guarded_getattr(c, 'a'), 1)
+        with self.assertRaises(ForbiddenAttribute):
+            guarded_getattr(c, 'b')
+
+    def test_installed(self):
+        d = {}
+        interpreter.exec_src('x = 1', d)
+        self.assertIs(d['_getattr_'], guarded_getattr)
+
+
 class Test_Interpreter(unittest.TestCase):
 
     def test_simple(self):
@@ -140,6 +251,23 @@ class Test_Compiled(unittest.TestCase):
         self.assertEqual(p.eval({'x': 3 + 2j}), 3.0)
         self.assertEqual(p.eval({}, {'x': 4 + 3j}), 4.0)
 
+    def test_CompiledExpression_eval_many(self):
+        p = interpreter.CompiledExpression('x.real * 2')
+        rows = [{'x': 1}, {'x': 2 + 1j}]
+        results = p.eval_many(rows)
+        self.assertEqual(list(results), [2, 4.0])
+        self.assertEqual(rows, [{'x': 1}, {'x': 2 + 1j}])
+
+    def test_CompiledExpression_eval_many_errors(self):
+        p = interpreter.CompiledExpression('1 / x')
+        rows = [{'x': 1}, {'x': 0}, {'x': 2}]
+        with self.assertRaises(ZeroDivisionError):
+            list(p.eval_many(rows))
+        results = list(p.eval_many(rows, collect_errors=True))
+        self.assertEqual(results[0], 1)
+        self.assertIsInstance(results[1], ZeroDivisionError)
+        self.assertEqual(results[2], 0.5)
+
     def test_CompiledCode_simple(self):
         code = rcompile.compile("21 * 2", "<string>", "eval")
         self.assertEqual(eval(code), 42)
@@ -167,3 +295,1409 @@ class Test_Compiled(unittest.TestCase):
         self.assertEqual(
             "('Line 1: Try statements are not allowed.',)",
             str(err.exception))
+
+
+class Test_CompileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = rcompile.CompileCache(maxsize=2)
+
+    def test_hit_returns_same_code(self):
+        code = self.cache.compile('x * 2', '<string>', 'eval')
+        self.assertIs(self.cache.compile('x * 2', '<string>', 'eval'), code)
+        self.assertEqual(self.cache.info(), (1, 1, 0, 2, 1))
+
+    def test_key_includes_filename_and_mode(self):
+        self.cache.compile('x', '<a>', 'eval')
+        self.cache.compile('x', '<b>', 'eval')
+        self.cache.compile('x', '<b>', 'exec')
+        self.assertEqual(self.cache.misses, 3)
+
+    def test_lru_eviction(self):
+        self.cache.compile('1', '<string>', 'eval')
+        self.cache.compile('2', '<string>', 'eval')
+        self.cache.compile('1', '<string>', 'eval')
+        self.cache.compile('3', '<string>', 'eval')
+        self.assertEqual(self.cache.evictions, 1)
+        self.cache.compile('1', '<string>', 'eval')
+        self.assertEqual(self.cache.hits, 2)
+        self.cache.resize(1)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.evictions, 2)
+
+    def test_invalidate(self):
+        self.cache.compile('1', '<a>', 'eval')
+        self.cache.compile('1', '<b>', 'eval')
+        self.assertEqual(self.cache.invalidate('1', filename='<a>'), 1)
+        self.assertEqual(self.cache.invalidate('1'), 1)
+        self.assertEqual(len(self.cache), 0)
+        self.cache.compile('1', '<a>', 'eval')
+        self.cache.clear()
+        self.assertEqual(self.cache.info(), (0, 0, 0, 2, 0))
+
+    def test_errors_are_not_cached(self):
+        for i in range(2):
+            with self.assertRaises(SyntaxError):
+                self.cache.compile("exec('x')", '<string>', 'exec')
+        self.assertEqual(len(self.cache), 0)
+
+    def test_warnings_are_replayed(self):
+        for i in range(2):
+            with self.assertWarns(SyntaxWarning):
+                self.cache.compile('print(1)', '<string>', 'exec')
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_disabled(self):
+        cache = rcompile.CompileCache(maxsize=0)
+        cache.compile('1', '<string>', 'eval')
+        self.assertEqual(len(cache), 0)
+
+    def test_invalid_mode(self):
+        with self.assertRaisesRegex(TypeError, '^unknown mode foo$'):
+            self.cache.compile('1', '<string>', 'foo')
+
+    def test_default_cache(self):
+        rcompile.cache.invalidate('42 * 3')
+        code = rcompile.compile('42 * 3', '<string>', 'eval')
+        self.assertIs(rcompile.compile('42 * 3', '<string>', 'eval'), code)
+
+    def test_compile_many(self):
+        cache = rcompile.CompileCache()
+        sources = ['x = 1', 'raise KeyError', 'x = 1', 'print(1)']
+        with ThreadPoolExecutor(2) as executor:
+            results = cache.compile_many(sources, '<s>', 'exec',
+                                         executor=executor)
+        self.assertEqual(len(results), 4)
+        self.assertIs(results[0], results[2])
+        self.assertEqual(cache.misses, 3)
+        self.assertIsNone(results[1].code)
+        self.assertEqual(results[1].errors,
+                         ('Line 1: Raise statements are not allowed.',))
+        self.assertEqual(len(results[3].warnings), 1)
+        d = {}
+        exec(results[0].code, d)
+        self.assertEqual(d['x'], 1)
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.compile('x = 1', '<s>', 'exec'), results[0].code)
+
+    def test_compile_many_previous(self):
+        cache = rcompile.CompileCache(maxsize=0)
+        first = cache.compile_many(['1', '2'], '<s>', 'eval')
+        second = cache.compile_many(['1', '3'], '<s>', 'eval',
+                                    previous=first)
+        self.assertIs(second[0], first[0])
+        self.assertEqual(eval(second[1].code), 3)
+        self.assertEqual(cache.misses, 3)
+        # Results compiled with another mode or filename are not reused.
+        third = cache.compile_many(['1'], '<s>', 'exec', previous=first)
+        self.assertIsNot(third[0], first[0])
+        self.assertEqual(third[0].mode, 'exec')
+        self.assertIsNone(eval(third[0].code))
+        fourth = cache.compile_many(['1'], '<t>', 'eval', previous=first)
+        self.assertEqual(fourth[0].code.co_filename, '<t>')
+
+    def test_compile_many_lru(self):
+        cache = rcompile.CompileCache(maxsize=2)
+        cache.compile_many(['1', '2'], '<s>', 'eval')
+        # Hits refresh the entries, so '2' is evicted rather than '1'.
+        cache.compile_many(['1'], '<s>', 'eval')
+        cache.compile('3', '<s>', 'eval')
+        self.assertEqual(cache.invalidate('1'), 1)
+        self.assertEqual(cache.invalidate('2'), 0)
+
+    def test_compile_many_process_pool(self):
+        results = self.cache.compile_many(
+            ['1 + 1', '2 + 2', 'x._y'], '<s>', 'eval', max_workers=2)
+        self.assertEqual([eval(r.code) for r in results[:2]], [2, 4])
+        self.assertTrue(results[2].errors)
+
+    def test_compile_many_invalid(self):
+        with self.assertRaisesRegex(TypeError, '^unknown mode foo$'):
+            self.cache.compile_many(['1'], '<s>', 'foo')
+        with self.assertRaises(TypeError):
+            self.cache.compile_many([object()], '<s>', 'eval')
+
+
+class Test_DiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = diskcache.DiskCache(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_load_without_compiling(self):
+        code = rcompile.CompileCache(store=self.store).compile(
+            'x * 3', '<string>', 'eval')
+        with mock.patch.object(rcompile, '_compile') as _compile:
+            loaded = rcompile.CompileCache(store=self.store).compile(
+                'x * 3', '<string>', 'eval')
+        _compile.assert_not_called()
+        self.assertEqual(loaded, code)
+        self.assertEqual(eval(loaded, {'x': 2}), 6)
+
+    def test_warnings_are_stored(self):
+        with self.assertWarns(SyntaxWarning):
+            rcompile.CompileCache(store=self.store).compile(
+                'print(1)', '<string>', 'exec')
+        with self.assertWarns(SyntaxWarning):
+            rcompile.CompileCache(store=self.store).compile(
+                'print(1)', '<string>', 'exec')
+
+    def test_policy_change_invalidates(self):
+        class Policy(UntrustedPythonNodeTransformer):
+            pass
+        self.assertNotEqual(
+            diskcache.fingerprint(Policy),
+            diskcache.fingerprint(UntrustedPythonNodeTransformer))
+        key = (rcompile.digest('1'), '<string>', 'eval',
+               UntrustedPythonNodeTransformer)
+        self.store.dump(key, (compile('1', '<string>', 'eval'), ()))
+        self.assertIsNotNone(self.store.load(key))
+        self.assertIsNone(self.store.load(key[:3] + (Policy,)))
+
+    def test_corrupt_entry(self):
+        cache = rcompile.CompileCache(store=self.store)
+        cache.compile('1', '<string>', 'eval')
+        for name in os.listdir(self.tmp.name):
+            with open(os.path.join(self.tmp.name, name), 'r+b') as f:
+                f.truncate(10)
+        cache = rcompile.CompileCache(store=self.store)
+        self.assertEqual(eval(cache.compile('1', '<string>', 'eval')), 1)
+
+    def test_clear(self):
+        rcompile.CompileCache(store=self.store).compile(
+            '1', '<string>', 'eval')
+        self.assertEqual(len(os.listdir(self.tmp.name)), 1)
+        self.store.clear()
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+
+class Test_ProcessPoolRunner(unittest.TestCase):
+
+    def test_submit(self):
+        shipped = interpreter.CompiledProgram('y = x * 2')
+        other = interpreter.CompiledProgram(
+            'print(x); res = printed\ndef f(): pass')
+        with interpreter.ProcessPoolRunner(1, programs=[shipped]) as runner:
+            result = runner.submit(shipped, {'x': 21}).result()
+            self.assertEqual(result, ({'x': 21, 'y': 42}, ''))
+            result = runner.submit(other, {'x': 1}).result()
+            self.assertEqual(result.output, '1\n')
+            # Functions cannot be pickled and are dropped:
+            self.assertEqual(sorted(result.namespace), ['res', 'x'])
+            result = runner.submit(
+                other, {'x': 2}, names=['res', 'missing']).result()
+            self.assertEqual(result.namespace, {'res': '2\n'})
+
+    def test_worker_warmed_up(self):
+        lazy = interpreter._LazySecurity()
+        with mock.patch.object(interpreter, '_security', lazy):
+            interpreter._init_worker({})
+            self.assertIsNot(interpreter._security, lazy)
+            self.assertIs(interpreter._security.SafeBuiltins, SafeBuiltins)
+
+    def test_errors(self):
+        p = interpreter.CompiledProgram('x = 1 / 0')
+        with interpreter.ProcessPoolRunner(1) as runner:
+            with self.assertRaises(ZeroDivisionError):
+                runner.submit(p).result()
+
+
+class Test_Async(unittest.TestCase):
+
+    def test_aexec_src(self):
+        d = {}
+        asyncio.run(interpreter.aexec_src('x = 1', d))
+        self.assertEqual(d['x'], 1)
+
+    def test_aeval(self):
+        p = interpreter.CompiledExpression('x * 2')
+        self.assertEqual(asyncio.run(p.aeval({'x': 2})), 4)
+
+    def test_aexec(self):
+        p = interpreter.CompiledProgram('print(x); res = printed')
+        f = StringIO()
+        asyncio.run(p.aexec({'x': 3}, output=f))
+        self.assertEqual(f.getvalue(), '3\n')
+
+    def test_timeout_and_limit(self):
+        runner = interpreter.AsyncRunner(limit=1)
+        event = threading.Event()
+
+        async def main():
+            blocking = asyncio.ensure_future(runner.run(event.wait))
+            await asyncio.sleep(0)
+            with self.assertRaises(asyncio.TimeoutError):
+                # Waits for the slot taken by `blocking`.
+                await runner.run(int, timeout=0.01)
+            event.set()
+            self.assertTrue(await blocking)
+            self.assertEqual(await runner.run(int, '3'), 3)
+
+        asyncio.run(main())
+
+    def test_limit_abandoned(self):
+        # An abandoned call keeps its slot until its thread is done.
+        runner = interpreter.AsyncRunner(limit=1)
+        event = threading.Event()
+
+        async def main():
+            with self.assertRaises(asyncio.TimeoutError):
+                await runner.run(event.wait, timeout=0.01)
+            with self.assertRaises(asyncio.TimeoutError):
+                await runner.run(int, timeout=0.05)
+            event.set()
+            self.assertEqual(await runner.run(int, '3', timeout=10), 3)
+
+        asyncio.run(main())
+
+
+class Test_Budget(unittest.TestCase):
+
+    def test_operations(self):
+        p = interpreter.CompiledProgram('while True:\n    pass')
+        budget = Budget(operations=100)
+        with self.assertRaises(BudgetExceeded):
+            p.exec_({}, budget=budget)
+        self.assertEqual(budget.operations_used, 101)
+
+    def test_seconds(self):
+        budget = Budget(seconds=0.01)
+        with self.assertRaises(BudgetExceeded):
+            interpreter.exec_src('while True:\n    pass', {}, budget=budget)
+        self.assertGreater(budget.elapsed, 0.01)
+
+    def test_consumed(self):
+        p = interpreter.CompiledExpression('abs(x) + 1')
+        budget = Budget()
+        self.assertEqual(p.eval({'x': -3}, budget=budget), 4)
+        self.assertGreater(budget.operations_used, 0)
+        self.assertGreater(budget.elapsed, 0)
+
+    def test_trusted_code_not_counted(self):
+        def helper():
+            for i in range(100):
+                pass
+        p = interpreter.CompiledProgram('helper()')
+        budget = Budget(operations=5)
+        p.exec_({'helper': helper}, budget=budget)
+        self.assertEqual(budget.operations_used, 1)
+
+    def test_trusted_code_named_like_untrusted_code(self):
+        trusted = {}
+        exec(compile('def helper():\n    for i in range(100):\n        pass',
+                     '<string>', 'exec'), trusted)
+        p = interpreter.CompiledProgram('helper()')
+        self.assertEqual(p.code.co_filename, '<string>')
+        budget = Budget(operations=5)
+        p.exec_({'helper': trusted['helper']}, budget=budget)
+        self.assertEqual(budget.operations_used, 1)
+
+    def test_functions_of_earlier_executions(self):
+        globals = {}
+        interpreter.CompiledProgram(
+            'def spin():\n    while True:\n        pass').exec_(globals)
+        with self.assertRaises(BudgetExceeded):
+            interpreter.CompiledProgram('spin()').exec_(
+                globals, budget=Budget(operations=100))
+
+    def test_concurrent(self):
+        p = interpreter.CompiledProgram(
+            'wait()\nn = 0\nwhile n < 50:\n    n = n + 1\nwait()')
+        alone = Budget()
+        p.exec_({'wait': lambda: None}, budget=alone)
+        barrier = threading.Barrier(2)
+        budget = Budget(memory=10 ** 9)
+        tracing = tracemalloc.is_tracing()
+        threads = [threading.Thread(target=p.exec_, args=(
+            {'wait': barrier.wait},), kwargs={'budget': budget})
+            for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(budget.operations_used, 2 * alone.operations_used)
+        self.assertEqual(tracemalloc.is_tracing(), tracing)
+
+    def test_cancel(self):
+        budget = Budget()
+        budget.cancel()
+        with self.assertRaises(BudgetExceeded):
+            interpreter.exec_src('x = 1', {}, budget=budget)
+
+    def test_output(self):
+        p = interpreter.CompiledProgram(
+            'print("a")\nprint("b")\nprint("c")\nres = printed')
+        budget = Budget(output=5)
+        f = StringIO()
+        with self.assertRaises(OutputLimitExceeded):
+            p.exec_({}, output=f, budget=budget)
+        # The output is streamed up to the limit:
+        self.assertEqual(f.getvalue(), 'a\nb\nc')
+        self.assertEqual(budget.output_used, 6)
+
+    def test_output_within_limit(self):
+        p = interpreter.CompiledProgram('print("a"); res = printed')
+        f = StringIO()
+        globals = {}
+        p.exec_(globals, output=f, budget=Budget(output=5))
+        self.assertEqual(f.getvalue(), 'a\n')
+        self.assertEqual(globals['res'], 'a\n')
+
+    def test_memory(self):
+        p = interpreter.CompiledProgram('x = "x" * 1000000\ny = 1')
+        budget = Budget(memory=100000)
+        with self.assertRaises(MemoryLimitExceeded):
+            p.exec_({}, budget=budget)
+        self.assertGreater(budget.memory_used, 1000000)
+        budget = Budget(memory=10000000)
+        p.exec_({}, budget=budget)
+        self.assertGreater(budget.memory_used, 1000000)
+
+    def test_async_timeout_stops_execution(self):
+        executor = ThreadPoolExecutor(1)
+        runner = interpreter.AsyncRunner(executor)
+        p = interpreter.CompiledProgram('while True:\n    pass')
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(p.aexec({}, runner=runner, timeout=0.01))
+        # Would block forever if the program kept running:
+        executor.shutdown(wait=True)
+
+
+class Test_Printing(unittest.TestCase):
+
+    def test_buffered_output(self):
+        written = []
+
+        class Output:
+            def write(self, text):
+                written.append(text)
+
+        p = interpreter.CompiledProgram(
+            'print("abc")\nprint("def")\nprint("g")\nres = printed')
+        globals = {}
+        p.exec_(globals, output=Output(), buffer_size=4)
+        self.assertEqual(written, ['abc\n', 'def\n', 'g\n'])
+        # The text is not kept in memory:
+        self.assertEqual(globals['res'], '')
+
+    def test_output_flushed_on_error(self):
+        p = interpreter.CompiledProgram('print("a")\nres = printed\nx = 1 / 0')
+        f = StringIO()
+        with self.assertRaises(ZeroDivisionError):
+            p.exec_({}, output=f, buffer_size=1024)
+        self.assertEqual(f.getvalue(), 'a\n')
+
+    def test_no_print(self):
+        f = StringIO()
+        interpreter.CompiledProgram('x = 1').exec_({}, output=f,
+                                                   buffer_size=0)
+        self.assertEqual(f.getvalue(), '')
+
+    def test_queue_writer(self):
+        p = interpreter.CompiledProgram('print(1)\nprint(2)\nres = printed')
+
+        async def main():
+            queue = asyncio.Queue()
+            output = printing.QueueWriter(queue, asyncio.get_running_loop())
+            await p.aexec({}, output=output, buffer_size=0)
+            await asyncio.sleep(0)
+            return [queue.get_nowait() for i in range(queue.qsize())]
+
+        self.assertEqual(asyncio.run(main()), ['1', '\n', '2', '\n'])
+
+
+class Test_ExecutionContext(unittest.TestCase):
+
+    def test_eval(self):
+        context = interpreter.ExecutionContext({'offset': 10})
+        p = interpreter.CompiledExpression('x.real + offset')
+        values = {'x': 1 + 2j}
+        self.assertEqual(context.eval(p, values), 11.0)
+        self.assertEqual(values, {'x': 1 + 2j})
+        code = rcompile.compile('offset * 2', '<string>', 'eval')
+        self.assertEqual(context.eval(code), 20)
+
+    def test_exec(self):
+        context = interpreter.ExecutionContext()
+        p = interpreter.CompiledProgram('y = x * 2; print(y); res = printed')
+        f = StringIO()
+        globals = context.exec_(p, {'x': 2}, output=f)
+        self.assertEqual(globals['y'], 4)
+        self.assertEqual(f.getvalue(), '4\n')
+        self.assertNotIn('y', context.namespace())
+
+    def test_protected_names(self):
+        context = interpreter.ExecutionContext({'__builtins__': {}})
+        globals = context.namespace({'__builtins__': {}, '_getattr_': None})
+        self.assertIs(globals['__builtins__'], SafeBuiltins)
+        self.assertIs(globals['_getattr_'], guarded_getattr)
+
+    def test_eval_with_locals(self):
+        context = interpreter.ExecutionContext({'y': 1})
+        p = interpreter.CompiledExpression('x.real + y')
+        self.assertEqual(p._guards, ('_getattr_',))
+        self.assertEqual(context.eval(p, {'x': 2, 'y': 2}), 4)
+        # Values cannot replace the guards:
+        self.assertEqual(
+            context.eval(p, {'x': 2, '_getattr_': None}), 3)
+
+    def test_eval_without_locals(self):
+        context = interpreter.ExecutionContext()
+        p = interpreter.CompiledExpression('(y := x) + y')
+        self.assertIsNone(p._guards)
+        values = {'x': 2}
+        self.assertEqual(context.eval(p, values), 4)
+        self.assertEqual(values, {'x': 2})
+        p = interpreter.CompiledExpression('(lambda: x)()')
+        self.assertIsNone(p._guards)
+        self.assertEqual(context.eval(p, values), 2)
+
+    def test_budget(self):
+        context = interpreter.ExecutionContext()
+        p = interpreter.CompiledProgram('while True:\n    pass')
+        with self.assertRaises(BudgetExceeded):
+            context.exec_(p, budget=Budget(operations=10))
+
+
+class Test_Templates(unittest.TestCase):
+
+    def test_same_shape_shares_compilation(self):
+        rcompile.cache.clear()
+        a = templates.TemplateExpression('price * (1 + 0.07)')
+        b = templates.TemplateExpression('price  *  1.08')
+        self.assertEqual(a.shape, b.shape)
+        self.assertEqual(rcompile.cache.info().misses, 1)
+        self.assertEqual(a.code.co_code, b.code.co_code)
+        self.assertAlmostEqual(a.eval({'price': 100}), 107.0)
+        self.assertAlmostEqual(b.eval({'price': 100}), 108.0)
+
+    def test_constant_folding(self):
+        shape, values = templates.parameterize('x + -2 * 3 + 2 ** 3')
+        self.assertEqual(values, [-6, 8])
+        shape, values = templates.parameterize('x + 1 / 0 + 2 ** 100')
+        self.assertEqual(values, [])
+
+    def test_literals_are_rebound(self):
+        for source, expected in [
+                ('x in (1, 2, "a")', False),
+                ('x in {3, 4}', True),
+                ('len("abc") + x', 6),
+                ('x.real + 1', 4.0),
+                ('a if 0 else b', 2),
+                ('1 and x', 3),
+                ('f"{x}!"', '3!'),
+                ('"a" + "b"', 'ab'),
+                ('(lambda y: y + 1)(x)', 4)]:
+            with self.subTest(source):
+                t = templates.TemplateExpression(source)
+                self.assertIsNotNone(t.shape)
+                self.assertEqual(
+                    t.eval({'x': 3, 'a': 1, 'b': 2}), expected)
+
+    def test_ExecutionContext(self):
+        t = templates.TemplateExpression('x * 3')
+        context = interpreter.ExecutionContext()
+        self.assertEqual(context.eval(t, {'x': 2}), 6)
+
+    def test_not_parameterized(self):
+        with mock.patch.object(templates, 'bind', return_value=None):
+            t = templates.TemplateExpression('x * 3')
+        self.assertIsNone(t.shape)
+        self.assertEqual(t.eval({'x': 2}), 6)
+
+    def test_errors(self):
+        with self.assertRaises(SyntaxError):
+            templates.TemplateExpression('x +')
+        with self.assertRaises(SyntaxError):
+            templates.TemplateExpression('x._y + 1')
+
+
+class Test_Diagnostics(unittest.TestCase):
+
+    def setUp(self):
+        self.checker = diagnostics.Checker()
+
+    def test_valid(self):
+        self.assertEqual(self.checker.check('x = 1\nres = x * 2'), ())
+
+    def test_violations(self):
+        result = self.checker.check(
+            'x = 1\nraise KeyError(x)\ny = x._z; exec("1")\n')
+        self.assertEqual(
+            [(d.severity, d.rule, d.node, d.line, d.column) for d in result],
+            [('error', 'not-allowed', 'Raise', 2, 0),
+             ('error', 'invalid-attribute', 'Attribute', 3, 4),
+             ('error', 'exec-call', 'Call', 3, 10)])
+
+    def test_syntax_error(self):
+        [d] = self.checker.check('x = (1')
+        self.assertEqual((d.rule, d.node, d.line), ('syntax', None, 1))
+
+    def test_compile_errors(self):
+        # Errors the compiler raises, though the source parses.
+        for source, line in [
+                ('return 1', 1), ('break', 1), ('continue', 1),
+                ('yield 1', 1), ('nonlocal x', 1),
+                ('def f():\n    await x', 2),
+                ('class A:\n    return 1', 2),
+                ('while x:\n    def f():\n        break', 3),
+                ('while x:\n    pass\nelse:\n    continue', 4)]:
+            with self.subTest(source=source):
+                [d] = self.checker.check(source)
+                self.assertEqual((d.rule, d.line), ('syntax', line))
+                with self.assertRaises(SyntaxError):
+                    rcompile.compile(source, '<s>', 'exec')
+        self.assertEqual(self.checker.check(
+            'for i in x:\n    if i:\n        break\n    continue'), ())
+
+    def test_bytes(self):
+        self.assertEqual(
+            self.checker.check(b'# coding: latin-1\nx = "\xe9"\n'), ())
+        [d] = self.checker.check(b'x = 1\n\n\nx = "\xe9"\n')
+        self.assertEqual(d.rule, 'syntax')
+        [d] = self.checker.check('x = 1\0')
+        self.assertEqual(d.rule, 'syntax')
+
+    def test_eval(self):
+        [d] = self.checker.check('a._b', mode='eval')
+        self.assertEqual((d.rule, d.line), ('invalid-attribute', 1))
+
+    def test_printed_warning(self):
+        [d] = self.checker.check('print(1)')
+        self.assertEqual((d.severity, d.rule), ('warning', 'printed'))
+        self.assertEqual(self.checker.check('print(1)\nres = printed'), ())
+
+    def test_cached(self):
+        result = self.checker.check('raise KeyError')
+        self.assertIs(self.checker.check('raise KeyError'), result)
+
+    def test_incremental(self):
+        source = 'x = 1\n@dec\ndef f():\n    raise KeyError\n'
+        self.checker.check(source)
+        with mock.patch.object(diagnostics, '_visit',
+                               wraps=diagnostics._visit) as visit:
+            [d] = self.checker.check('y = 2\n' + source)
+        self.assertEqual(visit.call_count, 1)
+        self.assertEqual(d.line, 5)
+
+    def test_default_checker(self):
+        self.assertEqual(diagnostics.check('x = 1'), ())
+
+
+class Test_Sandbox(unittest.TestCase):
+
+    prelude = 'rate = 2\ndef scale(x):\n    return x * rate\n'
+
+    def test_exec(self):
+        box = sandbox.Sandbox(self.prelude)
+        p = interpreter.CompiledProgram('result = scale(price)')
+        self.assertEqual(box.exec_(p, {'price': 10}),
+                         {'price': 10, 'result': 20})
+        self.assertEqual(box.exec_(p, {'price': 1}),
+                         {'price': 1, 'result': 2})
+
+    def test_isolation(self):
+        box = sandbox.Sandbox(self.prelude)
+        p = interpreter.CompiledProgram('rate = 3\nresult = scale(price)')
+        self.assertEqual(box.exec_(p, {'price': 10})['result'], 30)
+        p = interpreter.CompiledProgram('result = scale(price)')
+        self.assertEqual(box.exec_(p, {'price': 10}), {
+            'price': 10, 'result': 20})
+        self.assertEqual(box._snapshot['rate'], 2)
+
+    def test_protected_names(self):
+        box = sandbox.Sandbox('x = 1')
+        with box.namespace({'__builtins__': None, 'y': 2}) as globals:
+            self.assertIs(globals['__builtins__'], SafeBuiltins)
+            self.assertEqual((globals['x'], globals['y']), (1, 2))
+        with box.namespace() as globals:
+            self.assertNotIn('y', globals)
+
+    def test_clones_recycled(self):
+        box = sandbox.Sandbox(self.prelude, size=1)
+        with mock.patch.object(box, '_clone', wraps=box._clone) as clone:
+            with box.namespace():
+                with box.namespace():
+                    pass
+            with box.namespace():
+                pass
+        self.assertEqual(clone.call_count, 2)
+        self.assertEqual(len(box._pool), 1)
+
+    def test_eval(self):
+        box = sandbox.Sandbox(self.prelude)
+        e = interpreter.CompiledExpression('scale(x) + 1')
+        self.assertEqual(box.eval(e, {'x': 4}), 9)
+        e = interpreter.CompiledExpression('x * 2')
+        self.assertTrue(e.pure)
+        self.assertEqual(box.eval(e, {'x': 4}), 8)
+
+    def test_eval_isolation(self):
+        # Functions of the prelude changing globals only change the clone.
+        box = sandbox.Sandbox(
+            'n = 0\ndef bump():\n    global n\n    n = n + 1\n    return n\n')
+        e = interpreter.CompiledExpression('bump()')
+        self.assertEqual([box.eval(e) for i in range(3)], [1, 1, 1])
+        self.assertEqual(box._snapshot['n'], 0)
+        p = interpreter.CompiledProgram('y = bump()')
+        self.assertEqual(box.exec_(p), {'n': 1, 'y': 1})
+        self.assertEqual(box.eval(e), 1)
+
+    def test_mutable_values_copied(self):
+        box = sandbox.Sandbox(
+            'items = []\nconfig = {"seen": items}\nrow = []\n'
+            'rows = (row, 1)\n'
+            'def add(x):\n    items.append(x)\n    return len(items)\n')
+        p = interpreter.CompiledProgram(
+            'items.append(x)\nrow.append(x)\nn = add(x)\n'
+            'seen = len(config.get("seen"))')
+        for x in range(3):
+            self.assertEqual(box.exec_(p, {'x': x}),
+                             {'x': x, 'n': 2, 'seen': 2})
+        self.assertEqual(box._snapshot['items'], [])
+        self.assertEqual(box._snapshot['rows'], ([], 1))
+        self.assertEqual(len(box._pool), 1)
+        with box.namespace() as globals:
+            self.assertEqual(globals['items'], [])
+            self.assertEqual(globals['rows'], ([], 1))
+
+    def test_exported_functions(self):
+        box = sandbox.Sandbox('x = 0')
+        p = interpreter.CompiledProgram('def f():\n    return x')
+        f = box.exec_(p, {'x': 1})['f']
+        # The clone of f is not recycled.
+        self.assertEqual(len(box._pool), 0)
+        box.exec_(p, {'x': 2})
+        self.assertEqual(f(), 1)
+        box.exec_(interpreter.CompiledProgram('y = x'))
+        self.assertEqual(len(box._pool), 1)
+        g = box.eval(interpreter.CompiledExpression('lambda: x'), {'x': 3})
+        self.assertEqual(len(box._pool), 0)
+        self.assertEqual(g(), 3)
+
+    def test_output(self):
+        out = StringIO()
+        box = sandbox.Sandbox('print("ready")\nres = printed', output=out)
+        p = interpreter.CompiledProgram('print(x)\nres = printed')
+        box.exec_(p, {'x': 42}, output=out)
+        self.assertEqual(out.getvalue(), 'ready\n42\n')
+
+    def test_pool(self):
+        pool = sandbox.SandboxPool(max_tenants=2)
+        a = pool.sandbox('a', 'k = 1')
+        self.assertIs(pool.sandbox('a', 'k = 1'), a)
+        b = pool.sandbox('b', 'k = 2')
+        pool.sandbox('a', 'k = 1')
+        pool.sandbox('c', 'k = 3')
+        self.assertEqual(len(pool), 2)
+        self.assertIsNot(pool.sandbox('b', 'k = 2'), b)
+        self.assertIsNot(pool.sandbox('a', 'k = 4'), a)
+        pool.discard('a')
+        self.assertEqual(len(pool), 1)
+
+    def test_pool_dropped_source(self):
+        pool = sandbox.SandboxPool()
+        first = interpreter.CompiledProgram('k = 1')
+        first.drop_source()
+        a = pool.sandbox('a', first)
+        self.assertIs(pool.sandbox('a', first), a)
+        second = interpreter.CompiledProgram('k = 2')
+        second.drop_source()
+        self.assertIsNot(pool.sandbox('a', second), a)
+
+
+class Test_Profiling(unittest.TestCase):
+
+    def test_counts_and_timings(self):
+        profile = profiling.Profile()
+        p = interpreter.CompiledProgram(
+            'y = x.real + abs(x.imag) + len("ab")\nprint(y)\nres = printed')
+        out = StringIO()
+        p.exec_({'x': 3 + 4j}, output=out, profile=profile)
+        self.assertEqual(out.getvalue(), '9.0\n')
+        self.assertEqual(profile.executions, 1)
+        self.assertEqual(profile.getattr_calls, {'real': 1, 'imag': 1})
+        self.assertEqual(profile.builtin_calls, {'abs': 1, 'len': 1})
+        self.assertEqual(profile.timings['compile'], 0.0)
+        self.assertGreater(profile.timings['exec'], 0.0)
+        self.assertGreater(profile.timings['flush'], 0.0)
+
+    def test_exec_src(self):
+        profile = profiling.Profile()
+        d = {}
+        interpreter.exec_src('x = max(1, 2)', d, profile=profile)
+        self.assertEqual(d['x'], 2)
+        self.assertGreater(profile.timings['compile'], 0.0)
+        self.assertEqual(profile.builtin_calls, {'max': 1})
+
+    def test_builtins_stay_safe(self):
+        from zope.security.interfaces import ForbiddenAttribute
+        profile = profiling.Profile()
+        d = {'x': 1}
+        interpreter.exec_src('f = abs', d, profile=profile)
+        with self.assertRaises(ForbiddenAttribute):
+            d['f'].__globals__
+        interpreter.exec_src('y = str(x)', d, profile=profile)
+        self.assertEqual(d['y'], '1')
+        self.assertEqual(profile.builtin_calls, {})
+
+    def test_callback_and_stats(self):
+        calls = []
+        profile = profiling.Profile(callback=calls.append)
+        context = interpreter.ExecutionContext()
+        p = interpreter.CompiledProgram('y = x.real')
+        context.exec_(p, {'x': 1}, profile=profile)
+        context.exec_(p, {'x': 2}, profile=profile)
+        self.assertEqual(calls, [profile, profile])
+        stats = profile.stats()
+        self.assertEqual(stats['executions'], 2)
+        self.assertEqual(stats['getattr_calls'], {'real': 2})
+        self.assertEqual(sorted(stats['timings']), sorted(profiling.phases))
+
+    def test_globals_restored(self):
+        profile = profiling.Profile()
+        d = {'x': 1}
+        interpreter.exec_src('y = abs(x)', d, profile=profile)
+        self.assertIs(d['__builtins__'], SafeBuiltins)
+        self.assertIs(d['_getattr_'], guarded_getattr)
+        # Later executions without the profile are not counted.
+        interpreter.exec_src('z = abs(x)', d)
+        self.assertEqual(profile.builtin_calls, {'abs': 1})
+        globals = {'__builtins__': SafeBuiltins}
+        profile.restore(globals, profile.install(globals))
+        self.assertEqual(globals, {'__builtins__': SafeBuiltins})
+
+    def test_failed_execution(self):
+        calls = []
+        profile = profiling.Profile(callback=calls.append)
+        p = interpreter.CompiledProgram('y = abs(x)\nz = 1 / 0')
+        d = {'x': 1}
+        with self.assertRaises(ZeroDivisionError):
+            p.exec_(d, output=StringIO(), profile=profile)
+        self.assertEqual(calls, [profile])
+        self.assertEqual(profile.builtin_calls, {'abs': 1})
+        self.assertIs(d['__builtins__'], SafeBuiltins)
+        with self.assertRaises(ZeroDivisionError):
+            interpreter.exec_src('1 / 0', {}, profile=profile)
+        self.assertEqual(profile.executions, 2)
+
+    def test_sampling(self):
+        profile = profiling.Profile(interval=0.001)
+        p = interpreter.CompiledProgram(
+            'n = 0\nwhile n < 200000:\n    n = n + 1\n', '<tenant>')
+        p.exec_({}, profile=profile)
+        self.assertTrue(profile.lines)
+        for (filename, line), samples in profile.lines.items():
+            self.assertEqual(filename, '<tenant>')
+            self.assertIn(line, (2, 3))
+
+
+class Test_Vectorized(unittest.TestCase):
+
+    def _rows(self, source, columns):
+        p = interpreter.CompiledExpression(source)
+        rows = [dict(zip(columns, values))
+                for values in zip(*columns.values())]
+        return list(p.eval_many(rows))
+
+    def test_plan(self):
+        self.assertEqual(vectorized.plan('a * 2 < b').names, ['a', 'b'])
+        self.assertIsNone(vectorized.plan('a.real'))
+        self.assertIsNone(vectorized.plan('f(a)'))
+        self.assertIsNone(vectorized.plan('a if b else 1'))
+
+    def test_like_rows(self):
+        columns = {'a': [3, -7, 0, 12], 'b': [2, 5, 1, -4]}
+        for source in ('a + b * 2', 'a // b', 'a % b', '-a ** 2',
+                       'a / b', '0 < a < b', 'a > 1 or b > 1',
+                       'not a', 'a == 0 and b', '1 + 2', 'a ** 70'):
+            with self.subTest(source=source):
+                result = interpreter.CompiledExpression(
+                    source).eval_columns(columns)
+                expected = self._rows(source, columns)
+                self.assertEqual(result, expected)
+                self.assertEqual([type(r) for r in result],
+                                 [type(r) for r in expected])
+
+    def test_boolean_arithmetic(self):
+        # Python computes with booleans as integers.
+        columns = {'a': [1, 2, 3], 'b': [2, 3, 0]}
+        for source in ('(a > 1) + (b > 1)', '(a > 1) * (b > 1)',
+                       '(a > 1) - (b > 1)', '-(a > 1)', '+(a > 1)',
+                       '(a > 1) + True', 'a * (b > 1)'):
+            with self.subTest(source=source):
+                result = interpreter.CompiledExpression(
+                    source).eval_columns(columns)
+                expected = self._rows(source, columns)
+                self.assertEqual(result, expected)
+                self.assertEqual([type(r) for r in result],
+                                 [type(r) for r in expected])
+
+    def test_mixed_and_fallback(self):
+        columns = {'a': [1, 2.5, 'x'], 'b': ['y', 'z', 'w']}
+        p = interpreter.CompiledExpression('str(a)')
+        self.assertEqual(p.eval_columns(columns), ['1', '2.5', 'x'])
+        p = interpreter.CompiledExpression('b + b')
+        self.assertEqual(p.eval_columns(columns), ['yy', 'zz', 'ww'])
+        p = interpreter.CompiledExpression('a + 1')
+        self.assertEqual(p.eval_columns({'a': [1, 2.5]}), [2, 3.5])
+        self.assertIs(type(p.eval_columns({'a': [1, 2.5]})[0]), int)
+
+    def test_errors(self):
+        p = interpreter.CompiledExpression('a / b')
+        with self.assertRaises(ZeroDivisionError):
+            p.eval_columns({'a': [1.0, 2.0], 'b': [1.0, 0.0]})
+        with self.assertRaises(ValueError):
+            p.eval_columns({'a': [1], 'b': [1, 2]})
+        with self.assertRaises(NameError):
+            p.eval_columns({'a': [1]})
+
+    @unittest.skipIf(vectorized.numpy is None, 'NumPy is not installed')
+    def test_numpy(self):
+        import numpy
+        columns = {'a': numpy.arange(5), 'b': numpy.linspace(0, 1, 5)}
+        p = interpreter.CompiledExpression('a * b >= 1 and a < 4')
+        result = p.eval_columns(columns)
+        self.assertIsInstance(result, numpy.ndarray)
+        self.assertEqual(result.tolist(), [False, False, True, True, False])
+        # Integers beyond the exact range are computed by Python.
+        p = interpreter.CompiledExpression('a * a')
+        self.assertEqual(p.eval_columns({'a': numpy.array([2 ** 40, 3])}),
+                         [2 ** 80, 9])
+
+
+class Test_Service(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, 'socket')
+
+    def _serve(self, **kw):
+        server = service.Server(self.path, workers=1, poll_interval=0.05,
+                                **kw)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            thread.join()
+        self.addCleanup(stop)
+        return server, stop
+
+    def test_pipelining_and_recycling(self):
+        server, stop = self._serve(max_executions=3)
+        p = interpreter.CompiledProgram('y = x * 2\nprint(y)\nres = printed')
+        with service.Client(self.path, connections=2) as client:
+            futures = [client.submit(p, {'x': i}, names=['y'])
+                       for i in range(7)]
+            self.assertEqual([f.result() for f in futures],
+                             [({'y': i * 2}, f'{i * 2}\n') for i in range(7)])
+            result = client.exec_(p, {'x': 4})
+            self.assertEqual(result.namespace['res'], '8\n')
+        self.assertEqual(server.recycled, 2)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        stop()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_existing_path(self):
+        with open(self.path, 'w') as f:
+            f.write('data')
+        with self.assertRaises(FileExistsError):
+            service.Server(self.path)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'data')
+        os.unlink(self.path)
+        # A socket left by a previous server is replaced.
+        left = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        left.bind(self.path)
+        left.close()
+        self._serve()
+        with service.Client(self.path) as client:
+            result = client.exec_(interpreter.CompiledProgram('y = 1'))
+            self.assertEqual(result.namespace, {'y': 1})
+
+    def test_errors(self):
+        self._serve(timeout=1)
+        loop = interpreter.CompiledProgram('while True:\n    pass')
+        with service.Client(self.path) as client:
+            with self.assertRaises(ZeroDivisionError):
+                client.exec_(interpreter.CompiledProgram('x = 1 / 0'))
+            with self.assertRaises(BudgetExceeded):
+                client.exec_(loop, limits={'operations': 100})
+            with self.assertRaises(service.WorkerError):
+                client.exec_(loop)
+            # The worker was replaced:
+            result = client.exec_(interpreter.CompiledProgram('y = 1'))
+            self.assertEqual(result.namespace, {'y': 1})
+
+    def test_dropped_codes(self):
+        # Workers forget their codes after each execution, and the server
+        # only keeps the last one, so the client has to send them again.
+        self._serve(max_executions=1, max_codes=1)
+        p = interpreter.CompiledProgram('y = 1')
+        q = interpreter.CompiledProgram('y = 2')
+        with service.Client(self.path, connections=1) as client:
+            for program, y in (p, 1), (q, 2), (p, 1), (q, 2):
+                self.assertEqual(client.exec_(program).namespace, {'y': y})
+
+    def test_stopped_server(self):
+        server, stop = self._serve()
+        p = interpreter.CompiledProgram('y = 1')
+        with service.Client(self.path) as client:
+            client.exec_(p)
+            stop()
+            with self.assertRaises(ConnectionError):
+                client.exec_(p)
+
+
+class Test_Importer(unittest.TestCase):
+
+    def test_cache(self):
+        importer = builtins.Importer()
+        module = importer('string')
+        self.assertIs(importer('string', {}, None, (), 0), module)
+        self.assertIs(importer('zope.untrustedpython', {}, None, ['x']),
+                      importer('zope.untrustedpython', {}, None, ['y']))
+        with mock.patch.dict(sys.modules, {'string': builtins}):
+            self.assertIsNot(importer('string'), module)
+            self.assertEqual(importer('string').__name__,
+                             'zope.untrustedpython.builtins')
+        self.assertEqual(importer('string').__name__, 'string')
+
+    def test_relative(self):
+        importer = builtins.Importer()
+        package = {'__name__': 'zope.untrustedpython', '__path__': []}
+        module = {'__name__': 'zope.untrustedpython.foo'}
+        self.assertEqual(importer('guards', package).__name__,
+                         'zope.untrustedpython.guards')
+        self.assertEqual(importer('guards', module, None, ['x'], 1).__name__,
+                         'zope.untrustedpython.guards')
+        self.assertEqual(importer('untrustedpython', module, None, ['x'],
+                                  2).__name__, 'zope.untrustedpython')
+        with self.assertRaises(ImportError):
+            importer('string', module, None, ['x'], 1)
+        with self.assertRaisesRegex(ImportError, 'beyond top-level'):
+            importer('untrustedpython', module, None, ['x'], 3)
+        # A module shadowing an absolute import invalidates the entry.
+        self.assertEqual(importer('string', module).__name__, 'string')
+        with mock.patch.dict(
+                sys.modules, {'zope.untrustedpython.string': builtins}):
+            self.assertEqual(importer('string', module).__name__,
+                             'zope.untrustedpython.builtins')
+
+    def test_allowed(self):
+        importer = builtins.Importer(allowed=['zope.untrustedpython'])
+        self.assertEqual(
+            importer('zope.untrustedpython', {}, None, ['x']).__name__,
+            'zope.untrustedpython')
+        # The import statement would bind the top-level package.
+        with self.assertRaises(ImportError):
+            importer('zope.untrustedpython')
+        importer = builtins.Importer(allowed=['zope', 'zope.untrustedpython'])
+        self.assertEqual(importer('zope.untrustedpython').__name__, 'zope')
+        with self.assertRaises(ImportError):
+            importer('string')
+        with self.assertRaises(ImportError):
+            importer('not.imported')
+
+    def test_import_statement(self):
+        from zope.security.proxy import Proxy
+        d = {}
+        interpreter.exec_src('import string\nfrom zope import security', d)
+        self.assertEqual(d['string'].__name__, 'string')
+        self.assertIs(type(d['string']), Proxy)
+        context = interpreter.ExecutionContext(
+            builtins=builtins.make_safe_builtins(['string']))
+        with self.assertRaises(ImportError):
+            context.exec_(interpreter.CompiledProgram('import sys'))
+
+
+class Test_ProxyCache(unittest.TestCase):
+
+    def setUp(self):
+        from zope.security.checker import NamesChecker
+        from zope.security.checker import ProxyFactory
+
+        class Settings:
+            rate = 2
+
+        class Config:
+            settings = Settings()
+
+        self.config = ProxyFactory(Config(), NamesChecker(['settings']))
+        self.checker = NamesChecker(['rate'])
+        self.Settings = Settings
+        self.Config = Config
+
+    def test_interning(self):
+        from zope.security.checker import defineChecker
+        from zope.security.checker import undefineChecker
+        defineChecker(self.Settings, self.checker)
+        self.addCleanup(undefineChecker, self.Settings)
+        cache = guards.ProxyCache()
+        first = cache.getattr(self.config, 'settings')
+        self.assertIs(cache.getattr(self.config, 'settings'), first)
+        self.assertIsNot(guards.guarded_getattr(self.config, 'settings'),
+                         first)
+        self.assertEqual(cache.getattr(first, 'rate'), 2)
+        self.assertEqual((cache.created, cache.reused), (1, 1))
+        from zope.security.interfaces import ForbiddenAttribute
+        with self.assertRaises(ForbiddenAttribute):
+            cache.getattr(self.config, 'missing')
+        with self.assertRaises(ForbiddenAttribute):
+            cache.getattr(first, 'other')
+
+    def test_checker_proxy(self):
+        # The checker of a proxy makes the proxies of its attributes.
+        from zope.security.proxy import Proxy
+
+        class Checker:
+            def check_getattr(self, object, name):
+                pass
+
+            def proxy(self, value):
+                return ('proxied', value)
+
+        checker = Checker()
+        config = Proxy(self.Config(), checker)
+        cache = guards.ProxyCache()
+        expected = guards.guarded_getattr(config, 'settings')
+        self.assertEqual(expected[0], 'proxied')
+        self.assertEqual(cache.getattr(config, 'settings'), expected)
+        self.assertIs(cache.getattr(config, 'settings'),
+                      cache.getattr(config, 'settings'))
+        self.assertIsNot(cache.proxy(expected[1]), expected)
+
+    def test_bounded(self):
+        cache = guards.ProxyCache(maxsize=2)
+        objects = [self.Settings() for i in range(3)]
+        proxies = [cache.proxy(o) for o in objects]
+        self.assertIs(cache.proxy(objects[2]), proxies[2])
+        self.assertIsNot(cache.proxy(objects[0]), proxies[0])
+        self.assertEqual(cache.created, 4)
+        self.assertEqual(cache.proxy(1), 1)
+        uncached = guards.ProxyCache(maxsize=0)
+        self.assertIsNot(uncached.proxy(objects[0]), uncached.proxy(
+            objects[0]))
+
+    def test_context(self):
+        cache = guards.ProxyCache()
+        context = interpreter.ExecutionContext(
+            {'config': self.config}, proxies=cache)
+        p = interpreter.CompiledProgram(
+            'a = config.settings\nb = config.settings')
+        result = context.exec_(p)
+        self.assertIs(result['a'], result['b'])
+        self.assertEqual(cache.created, 1)
+
+
+class Test_PureExpressions(unittest.TestCase):
+
+    def test_classification(self):
+        for source in ('a + b * 2', 'x > 10 and y < 5', 'not -a ** 2',
+                       '1 <= x < 3 or None', '"a" + b'):
+            with self.subTest(source=source):
+                self.assertIsNotNone(rcompile.pure_expression(source))
+                self.assertTrue(interpreter.CompiledExpression(source).pure)
+        for source in ('a.real', 'f(a)', 'a[0]', '[a]', 'len', '_a',
+                       'a__roles__', 'printed', 'a if b else c',
+                       'lambda: 1', 'a +'):
+            with self.subTest(source=source):
+                self.assertIsNone(rcompile.pure_expression(source))
+        self.assertFalse(interpreter.CompiledExpression('len(a)').pure)
+        self.assertIsNone(rcompile.compile_pure(ast.parse('1', mode='eval')))
+
+    def test_eval(self):
+        p = interpreter.CompiledExpression('a + b * 2')
+        self.assertEqual(p.code.co_names, ('a', 'b'))
+        globals = {'a': 1, 'b': 2}
+        self.assertEqual(p.eval(globals), 5)
+        self.assertEqual(globals, {'a': 1, 'b': 2})
+        self.assertEqual(p.eval(globals, {'b': 3}), 7)
+        self.assertEqual(list(p.eval_many([{'a': 1, 'b': 1},
+                                           {'a': 'x', 'b': 'y'}])),
+                         [3, 'xyy'])
+        context = interpreter.ExecutionContext({'b': 10})
+        self.assertEqual(context.eval(p, {'a': 1}), 21)
+        with self.assertRaises(NameError):
+            p.eval({'a': 1, '__builtins__': builtins.SafeBuiltins})
+        with self.assertRaises(BudgetExceeded):
+            p.eval(globals, budget=Budget(operations=0))
+
+
+class Test_CompactCompiled(unittest.TestCase):
+
+    def test_slots(self):
+        import weakref
+        e = interpreter.CompiledExpression('x.real + 1')
+        self.assertFalse(hasattr(e, '__dict__'))
+        self.assertIs(weakref.ref(e)(), e)
+        self.assertFalse(hasattr(templates.TemplateExpression('1'),
+                                 '__dict__'))
+
+    def test_interned_code(self):
+        e = interpreter.CompiledExpression('x.real + 1')
+        self.assertIs(interpreter.CompiledExpression('x.real + 1').code,
+                      e.code)
+        self.assertIsNot(interpreter.CompiledExpression('x.real + 2').code,
+                         e.code)
+        self.assertIsNot(
+            interpreter.CompiledExpression('x.real + 1', '<other>').code,
+            e.code)
+        p = interpreter.CompiledProgram('y = x + 1')
+        self.assertIs(interpreter.CompiledProgram('y = x + 1').code, p.code)
+
+    def test_pickle(self):
+        import pickle
+        e = interpreter.CompiledExpression('x.real + 1', '<rule>')
+        copy = pickle.loads(pickle.dumps(e))
+        self.assertIs(copy.code, e.code)
+        self.assertEqual(copy.source, 'x.real + 1')
+        self.assertEqual(copy.eval({'x': 2}), 3)
+        self.assertFalse(copy.pure)
+        pure = pickle.loads(pickle.dumps(
+            interpreter.CompiledExpression('x + 1')))
+        self.assertTrue(pure.pure)
+        self.assertEqual(pure.eval({'x': 2}), 3)
+        t = pickle.loads(pickle.dumps(templates.TemplateExpression('x * 3')))
+        self.assertIsNotNone(t.shape)
+        self.assertEqual(t.eval({'x': 2}), 6)
+        p = interpreter.CompiledProgram('y = x + 1')
+        p.drop_source()
+        self.assertIsNone(p.source)
+        globals = {'x': 1}
+        pickle.loads(pickle.dumps(p)).exec_(globals)
+        self.assertEqual(globals['y'], 2)
+
+    def test_pickle_other_policy(self):
+        import pickle
+        e = interpreter.CompiledExpression('x.real + 1')
+        data = pickle.dumps(e)
+        e.drop_source()
+        dropped = pickle.dumps(e)
+        e.drop_source(functools.partial(str, 'x.real + 1'))
+        loaded = pickle.dumps(e)
+        with mock.patch.object(interpreter, '_fingerprint',
+                               return_value=b'other'):
+            # The source is compiled again instead of the bytecode loaded.
+            with mock.patch.object(interpreter.marshal, 'loads',
+                                   side_effect=AssertionError):
+                copy = pickle.loads(data)
+                self.assertEqual(copy.eval({'x': 2}), 3)
+                copy = pickle.loads(loaded)
+                self.assertEqual(copy.eval({'x': 2}), 3)
+                self.assertIsNone(copy._source)
+                self.assertEqual(copy.source, 'x.real + 1')
+            with self.assertRaises(pickle.UnpicklingError):
+                pickle.loads(dropped)
+
+    def test_layout(self):
+        # Sources differing in their layout keep their own line numbers.
+        p = interpreter.CompiledProgram('y = x.real\n')
+        q = interpreter.CompiledProgram('\ny = (\n    x.real)\n')
+        self.assertIsNot(p.code, q.code)
+        self.assertFalse(interpreter._identical(p.code, q.code))
+        self.assertIn(3, {line for start, end, line in q.code.co_lines()})
+
+    def test_dropped_source_consumers(self):
+        # Code whose source was dropped is evaluated row by row and
+        # estimated by its history only.
+        e = interpreter.CompiledExpression('a * 2 + b')
+        e.drop_source()
+        with mock.patch.object(vectorized, 'plan') as plan, \
+                mock.patch.object(scheduler, 'static_cost') as static_cost:
+            self.assertEqual(e.eval_columns({'a': [1, 2], 'b': [3, 4]}),
+                             [5, 8])
+            s = scheduler.Scheduler(max_processes=0)
+            self.assertIsNone(s.estimate(e))
+        plan.assert_not_called()
+        static_cost.assert_not_called()
+        e.drop_source(functools.partial(str, 'a * 2 + b'))
+        self.assertEqual(e.eval_columns({'a': [1, 2], 'b': [3, 4]}),
+                         [5, 8])
+        self.assertIsNotNone(s.estimate(e))
+
+    def test_drop_source(self):
+        e = interpreter.CompiledExpression('x.real + 1')
+        e.drop_source(lambda: 'x.real + 1')
+        self.assertIsNone(e._source)
+        self.assertEqual(e.source, 'x.real + 1')
+        self.assertEqual(e.eval({'x': 1}), 2)
+        e.source = 'x.real'
+        self.assertIsNone(e._loader)
+        self.assertEqual(e.source, 'x.real')
+
+
+class Test_Scheduler(unittest.TestCase):
+
+    loop = ('n = 0\nwhile n < 1000:\n    n = n + 1\n'
+            '    total = total + n\n')
+
+    def test_static_cost(self):
+        cost = scheduler.static_cost
+        self.assertEqual(cost('x = y'), 3)
+        self.assertIsNone(cost('x ='))
+        self.assertGreater(cost(self.loop), 1000 * 5)
+        # The loop runs its body of 3 operations 10 times.
+        self.assertEqual(cost('for i in range(10):\n    x = i'),
+                         3 + 10 * (1 + 3))
+        self.assertEqual(
+            cost('for i in range(10):\n    for j in [1, 2]:\n'
+                 '        x = j'),
+            3 + 10 * (1 + 3 + 2 * (1 + 3)))
+        self.assertEqual(cost('x = [i for i in y]', iterations=7),
+                         3 + 7 * 2)
+        self.assertGreater(cost('x = sorted(range(1024))'), 1024 * 10)
+        self.assertEqual(cost('while x:\n    x = x - 1'), math.inf)
+        self.assertEqual(cost('while True:\n    pass'), math.inf)
+        # The counter must be assigned in the loop.
+        self.assertEqual(cost('while n < 10:\n    pass'), math.inf)
+        self.assertEqual(cost('while n < 10:\n    n += 1'), 10 * (3 + 3))
+
+    def test_route(self):
+        cheap = interpreter.CompiledProgram('y = x * 2')
+        medium = interpreter.CompiledProgram(self.loop)
+        nested = interpreter.CompiledProgram(
+            'i = 0\nwhile i < 1000:\n    j = 0\n'
+            '    while j < 1000:\n        j = j + 1\n    i = i + 1\n')
+        s = scheduler.Scheduler()
+        self.assertEqual(s.route(cheap), 'inline')
+        self.assertEqual(s.route(medium), 'thread')
+        self.assertEqual(s.route(nested), 'process')
+        self.assertEqual(scheduler.Scheduler(max_processes=0).route(nested),
+                         'thread')
+        # The history takes precedence over the static cost.
+        s._record(cheap.code, 1.0)
+        self.assertEqual(s.estimate(cheap), 1.0)
+        self.assertEqual(s.route(cheap), 'process')
+        s._record(cheap.code, 0.0)
+        self.assertEqual(s.estimate(cheap), 0.75)
+        cheap.drop_source()
+        self.assertEqual(s.route(interpreter.CompiledProgram('y = x')),
+                         'inline')
+        dropped = interpreter.CompiledProgram('y = x * 3')
+        dropped.drop_source()
+        self.assertIsNone(s.estimate(dropped))
+        self.assertEqual(s.route(dropped), 'thread')
+        s._record(dropped.code, 0.0)
+        self.assertEqual(s.route(dropped), 'thread')
+
+    def test_route_unbounded(self):
+        s = scheduler.Scheduler()
+        forever = interpreter.CompiledProgram('while True:\n    pass')
+        self.assertEqual(s.estimate(forever), math.inf)
+        self.assertEqual(s.route(forever), 'process')
+        self.assertEqual(scheduler.Scheduler(max_processes=0).route(forever),
+                         'thread')
+        # Fast previous executions do not make it run inline.
+        loop = interpreter.CompiledProgram('while x:\n    x = x - 1')
+        s._record(loop.code, 0.0)
+        self.assertEqual(s.route(loop), 'thread')
+
+    def test_bounded(self):
+        bounded = scheduler.bounded
+        self.assertTrue(bounded('y = x * 2'))
+        self.assertTrue(bounded(self.loop))
+        self.assertTrue(bounded('for i in range(10):\n    x = [1, 2]'))
+        self.assertTrue(bounded('x = [j for j in (3, 1)]\ny = sorted((3, 1))'))
+        self.assertFalse(bounded('x ='))
+        self.assertFalse(bounded('while True:\n    pass'))
+        self.assertFalse(bounded('x = [i for i in y]'))
+        self.assertFalse(bounded('x = sorted(range(n))'))
+        self.assertFalse(bounded('x = list(y)'))
+        self.assertFalse(bounded('f = lambda: 1'))
+        s = scheduler.Scheduler(max_processes=0)
+        for source in [
+                'for i in range(n):\n    pass',
+                'for i in range(10**9):\n    pass',
+                'for i in y:\n    pass',
+                'def f(n):\n    return n < 2 or f(n - 1) + f(n - 2)\n'
+                'x = f(30)']:
+            program = interpreter.CompiledProgram(source)
+            self.assertLess(s.estimate(program), s.inline_limit)
+            self.assertEqual(s.route(program), 'thread')
+
+    def test_inline(self):
+        with scheduler.Scheduler() as s:
+            p = interpreter.CompiledProgram('y = x * 2')
+            future = s.submit(p, {'x': 21})
+            self.assertTrue(future.done())
+            self.assertEqual(future.result(), ({'x': 21, 'y': 42}, ''))
+            future = s.submit(interpreter.CompiledProgram('y = 1 / 0'))
+            with self.assertRaises(ZeroDivisionError):
+                future.result()
+            self.assertEqual(s.routed, {'inline': 2})
+            budget = Budget(operations=100)
+            s.submit(p, {'x': 1}, budget=budget).result()
+            self.assertGreater(budget.operations_used, 0)
+            # The running time was recorded.
+            self.assertIn(p.code, s._history)
+
+    def test_fairness(self):
+        # A single thread runs everything, while the first execution waits.
+        s = scheduler.Scheduler(max_threads=1, max_processes=0,
+                                max_queued=3, inline_limit=0)
+        self.addCleanup(s.shutdown)
+        started = threading.Event()
+        release = threading.Event()
+        order = []
+
+        def wait():
+            started.set()
+            release.wait(10)
+
+        block = s.submit(interpreter.CompiledProgram('wait()'),
+                         {'wait': wait}, names=[])
+        started.wait(10)
+        p = interpreter.CompiledProgram('log(name)')
+        futures = [s.submit(p, {'log': order.append, 'name': name},
+                            tenant=name[0], names=[])
+                   for name in ('a1', 'a2', 'a3', 'b1')]
+        self.assertEqual(s.queued('a'), 3)
+        self.assertEqual(s.queued('b'), 1)
+        with self.assertRaises(scheduler.QueueFull):
+            s.submit(p, {'log': order.append, 'name': 'a4'}, tenant='a')
+        release.set()
+        for future in [block, *futures]:
+            future.result(10)
+        self.assertEqual(order, ['a1', 'b1', 'a2', 'a3'])
+        self.assertEqual(s.routed, {'thread': 5})
+        self.assertEqual(s.queued('a'), 0)
+
+    def test_shutdown(self):
+        s = scheduler.Scheduler(max_threads=1, max_processes=0,
+                                inline_limit=0)
+        started = threading.Event()
+        release = threading.Event()
+
+        def wait():
+            started.set()
+            release.wait(10)
+
+        block = s.submit(interpreter.CompiledProgram('wait()'),
+                         {'wait': wait}, names=[])
+        started.wait(10)
+        queued = s.submit(interpreter.CompiledProgram('y = 1'))
+        s.shutdown(wait=False)
+        self.assertTrue(queued.cancelled())
+        release.set()
+        self.assertEqual(block.result(10).namespace, {})
+        with self.assertRaises(RuntimeError):
+            s.submit(interpreter.CompiledProgram('y = 1'))
+
+    def test_process(self):
+        with scheduler.Scheduler(max_processes=1, process_limit=0,
+                                 inline_limit=0) as s:
+            p = interpreter.CompiledProgram('y = x * 2')
+            budget = Budget(operations=100)
+            result = s.submit(p, {'x': 21}, budget=budget).result()
+            self.assertEqual(result, ({'x': 21, 'y': 42}, ''))
+            # The budget was used by a copy in the worker.
+            self.assertEqual(budget.operations_used, 0)
+            with self.assertRaises(ZeroDivisionError):
+                s.submit(interpreter.CompiledProgram('y = 1 / 0')).result()
+            self.assertEqual(s.routed, {'process': 2})
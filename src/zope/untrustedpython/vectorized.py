@@ -0,0 +1,248 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Evaluation of expressions over columns.
+
+Expressions made only of arithmetic, comparisons and boolean operators
+over names and literals cannot access attributes or call anything, so
+they are evaluated over whole columns instead of row by row: with NumPy
+if it is installed and the columns are numeric, with a plain function
+mapped over the columns otherwise.  Other expressions are evaluated row
+by row.
+"""
+import ast
+import functools
+import operator
+
+from zope.untrustedpython import rcompile
+
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+_binary_operators = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+
+_comparisons = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+# Integers NumPy computes with are exact, and exactly converted to
+# floats, below this bound.
+_exact = 2 ** 53
+
+
+class _Unsupported(Exception):
+    """The expression cannot be evaluated with NumPy."""
+
+
+class Plan:
+    """The analysis of a columnar expression.
+
+    `names` are the names used by the expression, `function` a plain
+    function taking their values in this order.
+    """
+
+    def __init__(self, tree, filename):
+        self.tree = tree
+        self.names = sorted({node.id for node in ast.walk(tree)
+                             if isinstance(node, ast.Name)})
+        arguments = ast.arguments(
+            posonlyargs=[], args=[ast.arg(name) for name in self.names],
+            kwonlyargs=[], kw_defaults=[], defaults=[])
+        function = ast.Expression(ast.Lambda(arguments, tree.body))
+        ast.fix_missing_locations(function)
+        self.function = eval(compile(function, filename, 'eval'),
+                             {'__builtins__': {}})
+
+
+@functools.lru_cache(maxsize=256)
+def plan(source, filename='<string>'):
+    """Return the `Plan` of `source`, None if it is not columnar.
+
+    Columnar expressions are the pure expressions of
+    `zope.untrustedpython.rcompile.pure_expression` whose literals are
+    numbers, strings or None.
+    """
+    tree = rcompile.pure_expression(source)
+    if tree is None:
+        return None
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Constant) and not isinstance(
+                node.value, (int, float, str, type(None))):
+            return None
+    return Plan(tree, filename)
+
+
+def _bound(node, bounds):
+    """Return an upper bound of the absolute integer values of `node`.
+
+    Floating point values count as 0, as NumPy raises when they overflow.
+    """
+    if isinstance(node, ast.Expression):
+        return _bound(node.body, bounds)
+    if isinstance(node, ast.Name):
+        return bounds[node.id]
+    if isinstance(node, ast.Constant):
+        return abs(node.value) if isinstance(node.value, int) else 0
+    if isinstance(node, ast.UnaryOp):
+        return _bound(node.operand, bounds)
+    if isinstance(node, ast.BinOp):
+        left = _bound(node.left, bounds)
+        right = _bound(node.right, bounds)
+        op = type(node.op)
+        if op in (ast.Add, ast.Sub):
+            result = left + right
+        elif op is ast.Mult:
+            result = left * right
+        elif op is ast.Pow:
+            result = 1 if left <= 1 else left ** min(right, 64)
+        elif op is ast.FloorDiv:
+            result = left
+        elif op is ast.Mod:
+            result = right
+        else:
+            result = 0
+        return max(result, left, right)
+    children = (node.values if isinstance(node, ast.BoolOp)
+                else [node.left, *node.comparators])
+    return max(_bound(child, bounds) for child in children)
+
+
+def _numeric(value):
+    """Return `value`, which must not be boolean.
+
+    Python computes with booleans as integers, NumPy keeps them boolean.
+    """
+    if numpy.asarray(value).dtype.kind == 'b':
+        raise _Unsupported
+    return value
+
+
+def _numpy_eval(node, arrays):
+    if isinstance(node, ast.Expression):
+        return _numpy_eval(node.body, arrays)
+    if isinstance(node, ast.Name):
+        return arrays[node.id]
+    if isinstance(node, ast.Constant):
+        if isinstance(node.value, (str, type(None))):
+            raise _Unsupported
+        return node.value
+    if isinstance(node, ast.BinOp):
+        return _binary_operators[type(node.op)](
+            _numeric(_numpy_eval(node.left, arrays)),
+            _numeric(_numpy_eval(node.right, arrays)))
+    if isinstance(node, ast.UnaryOp):
+        operand = _numpy_eval(node.operand, arrays)
+        if isinstance(node.op, ast.Not):
+            return numpy.logical_not(operand)
+        if isinstance(node.op, ast.USub):
+            return operator.neg(_numeric(operand))
+        return operator.pos(_numeric(operand))
+    if isinstance(node, ast.Compare):
+        result = True
+        left = _numpy_eval(node.left, arrays)
+        for op, comparator in zip(node.ops, node.comparators):
+            right = _numpy_eval(comparator, arrays)
+            result = numpy.logical_and(
+                result, _comparisons[type(op)](left, right))
+            left = right
+        return result
+    # Python returns one of the operands, which only agrees with the
+    # logical operators of NumPy for booleans.
+    values = [_numpy_eval(value, arrays) for value in node.values]
+    for value in values:
+        if numpy.asarray(value).dtype.kind != 'b':
+            raise _Unsupported
+    if isinstance(node.op, ast.And):
+        return functools.reduce(numpy.logical_and, values)
+    return functools.reduce(numpy.logical_or, values)
+
+
+def _with_numpy(plan, columns, length):
+    """Evaluate with NumPy, return None if that is not exact."""
+    arrays = {}
+    bounds = {}
+    for name in plan.names:
+        column = columns[name]
+        # Converting mixed sequences would change the types of the values.
+        if not isinstance(column, numpy.ndarray) and len(
+                set(map(type, column))) > 1:
+            return None
+        array = numpy.asarray(column)
+        kind = array.dtype.kind
+        if kind == 'i':
+            bounds[name] = max(abs(int(array.min(initial=0))),
+                               abs(int(array.max(initial=0))))
+        elif kind == 'f':
+            bounds[name] = 0
+        else:
+            return None
+        arrays[name] = array
+    if _bound(plan.tree, bounds) >= _exact:
+        return None
+    try:
+        with numpy.errstate(all='raise'):
+            result = _numpy_eval(plan.tree, arrays)
+    except (_Unsupported, ArithmeticError, ValueError, TypeError):
+        return None
+    return numpy.broadcast_to(result, (length,))
+
+
+def evaluate(expression, columns):
+    """Evaluate the `CompiledExpression` for each row of `columns`.
+
+    See `CompiledExpression.eval_columns`.
+    """
+    lengths = {len(column) for column in columns.values()}
+    if len(lengths) > 1:
+        raise ValueError('The columns differ in length.')
+    length = lengths.pop() if lengths else 0
+    source = expression.source
+    p = None
+    if source is not None:
+        p = plan(source, expression.code.co_filename)
+    if p is None or not set(p.names) <= set(columns):
+        rows = (dict(zip(columns, values))
+                for values in zip(*columns.values()))
+        return list(expression.eval_many(rows))
+    if numpy is not None:
+        result = _with_numpy(p, columns, length)
+        if result is not None:
+            if p.names and all(isinstance(columns[name], numpy.ndarray)
+                               for name in p.names):
+                return numpy.array(result)
+            return result.tolist()
+    if not p.names:
+        return [p.function()] * length
+    # The values of arrays are converted to Python ones, which do not
+    # overflow.
+    return list(map(p.function, *(
+        columns[name].tolist() if numpy is not None
+        and isinstance(columns[name], numpy.ndarray) else columns[name]
+        for name in p.names)))